@@ -0,0 +1,83 @@
+"""
+Exports, imports and reports on the user table of the configured storage (BOT_STORAGE_BACKEND):
+
+    python admin.py export [--format jsonl|csv] [--output users.jsonl]
+    python admin.py import users.jsonl [--format jsonl|csv] [--batch-size 1000]
+    python admin.py report [--json]
+
+Users are streamed one at a time, so memory doesn't grow with the table. Exporting from
+SQLite is safe while the bot runs; import with the bot stopped, as the running bot keeps
+the users in memory and would overwrite the imported ones. With TinyDB every import batch
+rewrites db.json, so big imports go to SQLite (see migrate.py).
+"""
+import argparse
+import json
+import sys
+import time
+
+import config
+from dump import FORMATS, format_of, read_users, write_users
+from levels import English_level_names
+from reports import UserStats, render_report
+from storage import import_documents, iter_users, open_storage
+
+
+def export(args):
+    format = args.format or format_of(args.output)
+    started = time.perf_counter()
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8', newline='') as f:
+            exported = write_users(iter_users(), f, format)
+    else:
+        exported = write_users(iter_users(), sys.stdout, format)
+    print("Exported {} users in {:.2f}s".format(exported, time.perf_counter() - started), file=sys.stderr)
+
+
+def import_(args):
+    format = args.format or format_of(args.input)
+    started = time.perf_counter()
+    storage = open_storage()
+    try:
+        with open(args.input, encoding='utf-8', newline='') as f:
+            imported = import_documents(read_users(f, format), storage, batch_size=args.batch_size)
+    finally:
+        storage.close()
+    print("Imported {} users from {} into the {} storage in {:.2f}s".format(
+        imported, args.input, config.STORAGE_BACKEND, time.perf_counter() - started), file=sys.stderr)
+
+
+def report(args):
+    stats = UserStats()
+    for user in iter_users():
+        stats.add(user)
+    if args.json:
+        print(json.dumps(stats.report(), indent=2))
+    else:
+        print(render_report(stats.report(), English_level_names))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('export', help='write the users as JSON Lines or CSV')
+    command.add_argument('--format', choices=FORMATS, help='(default: by the extension of --output, else jsonl)')
+    command.add_argument('--output', help='(default: stdout)')
+    command.set_defaults(run=export)
+
+    command = commands.add_parser('import', help='upsert the users of an export')
+    command.add_argument('input')
+    command.add_argument('--format', choices=FORMATS, help='(default: by the extension of the input, else jsonl)')
+    command.add_argument('--batch-size', type=int, default=1000, help='users per transaction (default: %(default)s)')
+    command.set_defaults(run=import_)
+
+    command = commands.add_parser('report', help='users per level, ages, availability and the registration funnel')
+    command.add_argument('--json', action='store_true')
+    command.set_defaults(run=report)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
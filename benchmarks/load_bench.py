@@ -0,0 +1,285 @@
+"""
+Drives the bot's dispatcher with synthetic updates against a fake Bot API, without a token.
+
+    python benchmarks/load_bench.py [--users 10000] [--backend tinydb] [--scenarios register churn list]
+                                    [--match-mode batch] [--match-every 1000]
+                                    [--output results.json] [--compare baseline.json]
+
+The dispatcher gets the same handlers as in production (main.add_handlers) and every update
+goes through Dispatcher.process_update, so the ConversationHandler routing is measured too.
+Bot API calls are answered in-process (optionally after --api-latency seconds), the typing
+pauses are turned off and the flood limits lifted, so the numbers are the bot's own cost.
+With --match-mode batch the matcher runs after every --match-every updates, as the job
+queue would run it every BOT_MATCH_INTERVAL seconds; its time counts towards the scenario
+but not towards the update latencies. The availability expiry isn't run: a scenario takes
+far less than BOT_AVAILABILITY_TTL, so nothing would be due.
+For every scenario the updates per second, the p50/p99 latency of an update and the storage
+operations and rows written are reported. The results are written to --output as JSON, and
+--compare prints the change against an earlier run.
+"""
+import argparse
+import datetime
+import itertools
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from queue import Queue
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+LEVELS = ['A1', 'A1+', 'A2', 'A2+', 'B1', 'B1+', 'B2', 'B2+', 'C1', 'C1+', 'C2']
+HOBBIES = ['reading', 'hiking', 'chess', 'football', 'cooking', 'movies', 'music', 'travelling', 'gaming',
+           'photography', 'yoga', 'drawing', 'programming', 'history', 'dancing', 'fishing']
+
+
+class FakeBotAPI:
+    """Stands in for telegram.utils.request.Request and answers every call like the Bot API would."""
+
+    con_pool_size = 8
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = {}
+        self._message_ids = itertools.count(1)
+
+    def post(self, url, data=None, timeout=None):
+        method = url.rsplit('/', 1)[1]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'bot', 'username': 'bot'}
+        if method in ('sendChatAction', 'answerCallbackQuery'):
+            return True
+        return {'message_id': next(self._message_ids), 'date': int(time.time()), 'text': data.get('text', ''),
+                'chat': {'id': data.get('chat_id', 0), 'type': 'private'}}
+
+    def stop(self):
+        pass
+
+
+class Updates:
+    """Builds updates as the Bot API sends them (see user_of() and Update.de_json)."""
+
+    def __init__(self):
+        self._ids = itertools.count(1)
+
+    def _user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': 'User', 'username': 'user{}'.format(user_id)}
+
+    def _message(self, user_id, text):
+        message = {'message_id': next(self._ids), 'date': int(time.time()), 'text': text,
+                   'chat': {'id': user_id, 'type': 'private'}, 'from': self._user(user_id)}
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return message
+
+    def message(self, user_id, text):
+        return {'update_id': next(self._ids), 'message': self._message(user_id, text)}
+
+    def callback(self, user_id, data):
+        return {'update_id': next(self._ids), 'callback_query': {
+            'id': str(next(self._ids)), 'from': self._user(user_id), 'chat_instance': str(user_id), 'data': data,
+            'message': self._message(user_id, 'list'),
+        }}
+
+
+def user_of(data):
+    return (data.get('message') or data['callback_query'])['from']['id']
+
+
+def register_scenario(updates, user_ids):
+    for user_id in user_ids:
+        yield updates.message(user_id, '/start')
+        yield updates.message(user_id, 'User {}'.format(user_id))
+        yield updates.message(user_id, random.choice(LEVELS))
+        yield updates.message(user_id, str(random.randint(14, 70)))
+        yield updates.message(user_id, ', '.join(random.sample(HOBBIES, 3)))
+
+
+def churn_scenario(updates, user_ids, count):
+    for _ in range(count):
+        yield updates.message(random.choice(user_ids), random.choice(('/available', '/busy')))
+
+
+def list_scenario(updates, user_ids, count):
+    for _ in range(count):
+        user_id = random.choice(user_ids)
+        if random.random() < 0.5:
+            yield updates.message(user_id, random.choice(('/list', '/list available', '/list ' + random.choice(LEVELS))))
+        else:
+            yield updates.callback(user_id, 'list:{}::{}'.format(random.randrange(len(LEVELS)), random.randrange(5)))
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+def run_scenario(main, dispatcher, api, updates, match_every=0):
+    from telegram import Update
+    from telegram.ext import CallbackContext
+
+    metrics = main.bot_metrics
+    operations = ('insert', 'get', 'update', 'remove', 'all', 'available_by_level', 'write_batch')
+    storage_before = {operation: (metrics.storage_latency.count(operation), metrics.storage_latency.total(operation),
+                                  metrics.storage_rows_written.value(operation)) for operation in operations}
+    calls_before = sum(api.calls.values())
+
+    updates = [Update.de_json(data, dispatcher.bot) for data in updates]
+    context = CallbackContext(dispatcher)
+    latencies = []
+    matcher_runs = 0
+    matcher_seconds = 0.0
+    started = time.perf_counter()
+    for number, update in enumerate(updates, 1):
+        update_started = time.perf_counter()
+        dispatcher.process_update(update)
+        latencies.append(time.perf_counter() - update_started)
+        if match_every and number % match_every == 0:
+            matcher_started = time.perf_counter()
+            main.matcher.run(context)
+            matcher_seconds += time.perf_counter() - matcher_started
+            matcher_runs += 1
+    elapsed = time.perf_counter() - started
+
+    # The write-behind flush and the outbox are part of the work, but not of the update latency.
+    main.users.flush()
+    while main.outbox.depth():
+        time.sleep(0.01)
+    drained = time.perf_counter() - started
+
+    storage = {}
+    for operation, (count, total, rows) in storage_before.items():
+        count = metrics.storage_latency.count(operation) - count
+        if count:
+            storage[operation] = {'count': count, 'seconds': metrics.storage_latency.total(operation) - total,
+                                  'rows_written': metrics.storage_rows_written.value(operation) - rows}
+
+    latencies.sort()
+    return {
+        'updates': len(updates),
+        'seconds': elapsed,
+        'updates_per_second': len(updates) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': latencies[-1] * 1000 if latencies else 0.0,
+        'drained_seconds': drained,
+        'api_calls': sum(api.calls.values()) - calls_before,
+        'matcher_runs': matcher_runs,
+        'matcher_seconds': matcher_seconds,
+        'storage': storage,
+    }
+
+
+def print_results(results, baseline=None):
+    print("{:<10}{:>9}{:>12}{:>10}{:>10}{:>11}{:>13}{:>13}".format(
+        'scenario', 'updates', 'updates/s', 'p50 ms', 'p99 ms', 'api calls', 'storage ops', 'rows written'))
+    for name, result in results['scenarios'].items():
+        storage = result['storage'].values()
+        print("{:<10}{:>9}{:>12.0f}{:>10.3f}{:>10.3f}{:>11}{:>13}{:>13}".format(
+            name, result['updates'], result['updates_per_second'], result['p50_ms'], result['p99_ms'],
+            result['api_calls'], sum(stats['count'] for stats in storage), sum(stats['rows_written'] for stats in storage)))
+
+        previous = (baseline or {}).get('scenarios', {}).get(name)
+        if previous:
+            print("{:<10}{:>9}{:>+11.1f}%{:>+9.1f}%{:>+9.1f}%".format(
+                '  vs base', '', _change(previous['updates_per_second'], result['updates_per_second']),
+                _change(previous['p50_ms'], result['p50_ms']), _change(previous['p99_ms'], result['p99_ms'])))
+
+
+def _change(old, new):
+    return (new - old) / old * 100 if old else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=10000, help='users that register in the register scenario')
+    parser.add_argument('--churn', type=int, default=20000, help='/available and /busy updates')
+    parser.add_argument('--lists', type=int, default=2000, help='/list commands and page callbacks')
+    parser.add_argument('--backend', choices=('tinydb', 'sqlite'), default='tinydb')
+    parser.add_argument('--match-mode', choices=('instant', 'batch'), default='instant')
+    parser.add_argument('--match-every', type=int, default=1000, help='updates between batch matcher runs')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='seconds every fake Bot API call takes')
+    parser.add_argument('--scenarios', nargs='+', choices=('register', 'churn', 'list'), default=['register', 'churn', 'list'])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='where to save the results as JSON')
+    parser.add_argument('--compare', help='results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    directory = tempfile.mkdtemp(prefix='load_bench-')
+    # config reads these when main is imported.
+    os.environ.update({
+        'BOT_STORAGE_BACKEND': args.backend,
+        'BOT_DB_PATH': os.path.join(directory, 'db.json'),
+        'BOT_SQLITE_PATH': os.path.join(directory, 'db.sqlite3'),
+        'BOT_CONVERSATIONS_PATH': os.path.join(directory, 'conversations'),
+        'BOT_HISTORY_PATH': os.path.join(directory, 'matches.log'),
+        'BOT_MATCH_MODE': args.match_mode,
+        'BOT_TYPING_DELAY_SCALE': '0',
+        'BOT_OUTBOX_GLOBAL_RATE': '1000000',
+        'BOT_OUTBOX_GLOBAL_BURST': '1000000',
+        'BOT_OUTBOX_CHAT_RATE': '1000000',
+        'BOT_OUTBOX_CHAT_BURST': '1000000',
+        'BOT_METRICS_PORT': '0',
+        'BOT_LOG_PATH': os.path.join(directory, 'debug.log'),
+        'BOT_LOG_LEVEL': 'WARNING',
+    })
+
+    from telegram import Bot
+    from telegram.ext import Dispatcher, JobQueue
+    import main as bot_main
+
+    api = FakeBotAPI(args.api_latency)
+    bot = Bot('123456:' + 'A' * 35, request=api)
+    job_queue = JobQueue()
+    dispatcher = Dispatcher(bot, Queue(), job_queue=job_queue, persistence=bot_main.persistence)
+    job_queue.set_dispatcher(dispatcher)
+    bot_main.add_handlers(dispatcher)
+
+    job_queue.start()
+    bot_main.users.start()
+    bot_main.outbox.start()
+
+    updates = Updates()
+    user_ids = list(range(1, args.users + 1))
+    scenarios = {
+        'register': lambda: register_scenario(updates, user_ids),
+        'churn': lambda: churn_scenario(updates, user_ids, args.churn),
+        'list': lambda: list_scenario(updates, user_ids, args.lists),
+    }
+
+    results = {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'arguments': vars(args),
+        'scenarios': {},
+    }
+    for name in args.scenarios:
+        results['scenarios'][name] = run_scenario(bot_main, dispatcher, api, scenarios[name](),
+                                                   args.match_every if args.match_mode == 'batch' else 0)
+
+    bot_main.outbox.stop()
+    job_queue.stop()
+    bot_main.persistence.close()
+    bot_main.users.close()
+    bot_main.history.close()
+    shutil.rmtree(directory, ignore_errors=True)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
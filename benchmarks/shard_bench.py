@@ -0,0 +1,122 @@
+"""
+Measures how the update throughput of the sharded mode (sharding.py) scales with the workers.
+
+    python benchmarks/shard_bench.py [--workers 1 2 4 8] [--users 5000] [--churn 10000] [--output results.json]
+
+For every worker count a fresh front process is started with its own SQLite database. It
+starts the workers with a fake Bot API (see load_bench.py), hands them the updates of
+--users registrations followed by --churn /available and /busy commands, and waits until
+every worker has handled its share. The throughput only scales with the workers as long as
+there are idle cores for them: the front and every worker are separate processes.
+"""
+import argparse
+import functools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from load_bench import FakeBotAPI, Updates, register_scenario, churn_scenario, user_of, percentile  # noqa: E402
+
+
+def fake_bot(api_latency):
+    from telegram import Bot
+    return Bot('123456:' + 'A' * 35, request=FakeBotAPI(api_latency))
+
+
+def run(workers, args):
+    """Runs in the front process started by main()."""
+    import random
+    random.seed(args.seed)
+
+    import main as bot
+    from sharding import Coordinator
+
+    updates = Updates()
+    user_ids = list(range(1, args.users + 1))
+    scenarios = {
+        'register': list(register_scenario(updates, user_ids)),
+        'churn': list(churn_scenario(updates, user_ids, args.churn)),
+    }
+
+    coordinator = Coordinator(workers, bot.users, bot.pool, make_bot=functools.partial(fake_bot, args.api_latency),
+                              measure=True)
+    coordinator.start()
+
+    results = {}
+    for name, scenario in scenarios.items():
+        started = time.perf_counter()
+        for data in scenario:
+            coordinator.submit(user_of(data), data)
+        latencies = sorted(coordinator.barrier())
+        elapsed = time.perf_counter() - started
+        results[name] = {
+            'updates': len(scenario),
+            'seconds': elapsed,
+            'updates_per_second': len(scenario) / elapsed,
+            'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+        }
+
+    coordinator.stop()
+    print(json.dumps(results))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--churn', type=int, default=10000)
+    parser.add_argument('--api-latency', type=float, default=0.0, help='seconds every fake Bot API call takes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='where to save the results as JSON')
+    parser.add_argument('--run', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        run(args.run, args)
+        return
+
+    print("{} cores".format(os.cpu_count()))
+    print("{:<9}{:<10}{:>12}{:>10}{:>10}{:>10}".format('workers', 'scenario', 'updates/s', 'speedup', 'p50 ms', 'p99 ms'))
+    results = {'cores': os.cpu_count(), 'arguments': vars(args), 'workers': {}}
+    for workers in args.workers:
+        with tempfile.TemporaryDirectory() as directory:
+            environment = dict(os.environ, **{
+                'BOT_SHARDS': str(workers),
+                'BOT_STORAGE_BACKEND': 'sqlite',
+                'BOT_SQLITE_PATH': os.path.join(directory, 'db.sqlite3'),
+                'BOT_CONVERSATIONS_PATH': os.path.join(directory, 'conversations'),
+                'BOT_HISTORY_PATH': os.path.join(directory, 'matches.log'),
+                'BOT_TYPING_DELAY_SCALE': '0',
+                'BOT_OUTBOX_GLOBAL_RATE': '1000000',
+                'BOT_OUTBOX_GLOBAL_BURST': '1000000',
+                'BOT_OUTBOX_CHAT_RATE': '1000000',
+                'BOT_OUTBOX_CHAT_BURST': '1000000',
+                'BOT_METRICS_PORT': '0',
+                'BOT_LOG_PATH': os.path.join(directory, 'debug.log'),
+                'BOT_LOG_LEVEL': 'WARNING',
+            })
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--run', str(workers), '--users', str(args.users),
+                 '--churn', str(args.churn), '--api-latency', str(args.api_latency), '--seed', str(args.seed)],
+                env=environment, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        results['workers'][workers] = json.loads(output.strip().splitlines()[-1])
+
+        for name, result in results['workers'][workers].items():
+            single = results['workers'].get(args.workers[0], {}).get(name)
+            print("{:<9}{:<10}{:>12.0f}{:>9.2f}x{:>10.3f}{:>10.3f}".format(
+                workers, name, result['updates_per_second'], result['updates_per_second'] / single['updates_per_second'],
+                result['p50_ms'], result['p99_ms']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
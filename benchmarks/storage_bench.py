@@ -0,0 +1,103 @@
+"""
+Compares the TinyDB and SQLite storage backends at 1k, 10k and 100k users.
+
+    python benchmarks/storage_bench.py [--sizes 1000 10000 100000] [--ops 100]
+
+Every backend is filled with a bulk write_batch, then the single-row operations are timed
+one by one (each of them is a separate write, i.e. what the bot pays without the
+write-behind repository in front).
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from storage import TinyDBStorage, SQLiteStorage, import_tinydb  # noqa: E402
+
+
+def make_user(user_id):
+    return {
+        'id': user_id,
+        'chat_id': user_id,
+        'nick_name': 'user{}'.format(user_id),
+        'name': 'User {}'.format(user_id),
+        'level': random.randrange(11),
+        'age': random.randint(14, 70),
+        'hobbies': 'reading, hiking and playing chess',
+        'available': random.random() < 0.2,
+    }
+
+
+def timed(operation, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        operation()
+    return (time.perf_counter() - started) / repeat
+
+
+def available_by_level(storage):
+    # TinyDB answers a repeated query from its cache until the next write, which would time a lookup, not a scan.
+    if isinstance(storage, TinyDBStorage):
+        storage._table.clear_cache()
+    low = random.randrange(8)
+    return storage.available_by_level(low, low + 3)
+
+
+def bench_backend(storage, size, ops):
+    results = {}
+
+    started = time.perf_counter()
+    storage.write_batch([make_user(user_id) for user_id in range(size)], [])
+    results['bulk load'] = time.perf_counter() - started
+
+    ids = iter(range(size, size + ops))
+    results['insert'] = timed(lambda: storage.insert(make_user(next(ids))), ops)
+    results['get'] = timed(lambda: storage.get(random.randrange(size)), ops)
+    results['update'] = timed(lambda: storage.update(random.randrange(size), {'available': True}), ops)
+    results['available_by_level'] = timed(lambda: available_by_level(storage), ops)
+    results['remove'] = timed(lambda: storage.remove(random.randrange(size)), ops)
+    results['write_batch (100 upserts)'] = timed(
+        lambda: storage.write_batch([make_user(random.randrange(size)) for _ in range(100)], []), max(1, ops // 10))
+    results['all'] = timed(lambda: sum(1 for _ in storage.all()), 3)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--ops', type=int, default=100, help='timed repetitions of every single-row operation')
+    args = parser.parse_args()
+
+    random.seed(0)
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            json_path = os.path.join(directory, 'db.json')
+            tinydb = TinyDBStorage(json_path)
+            tinydb_results = bench_backend(tinydb, size, args.ops)
+            tinydb.close()
+
+            sqlite = SQLiteStorage(os.path.join(directory, 'db.sqlite3'))
+            sqlite_results = bench_backend(sqlite, size, args.ops)
+            sqlite.close()
+
+            imported = SQLiteStorage(os.path.join(directory, 'imported.sqlite3'))
+            started = time.perf_counter()
+            import_tinydb(json_path, imported)
+            import_time = time.perf_counter() - started
+            imported.close()
+
+        print("\n{} users".format(size))
+        print("{:<28}{:>14}{:>14}{:>10}".format('operation', 'tinydb', 'sqlite', 'speedup'))
+        for operation in tinydb_results:
+            print("{:<28}{:>12.3f}ms{:>12.3f}ms{:>9.1f}x".format(
+                operation, tinydb_results[operation] * 1000, sqlite_results[operation] * 1000,
+                tinydb_results[operation] / sqlite_results[operation]))
+        print("{:<28}{:>12.3f}ms".format('import db.json -> sqlite', import_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+import os
+
+
+def _env(name, default, cast=str):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return cast(value)
+
+
+# 'tinydb' keeps the users in DB_PATH, 'sqlite' in SQLITE_PATH (see migrate.py to move them over).
+STORAGE_BACKEND = _env('BOT_STORAGE_BACKEND', 'tinydb')
+DB_PATH = _env('BOT_DB_PATH', 'db.json')
+SQLITE_PATH = _env('BOT_SQLITE_PATH', 'db.sqlite3')
+
+# Write-behind persistence of the user store: changes are flushed at least every
+# FLUSH_INTERVAL seconds (the durability bound) or as soon as FLUSH_MAX_PENDING
+# changes have piled up, whichever comes first.
+FLUSH_INTERVAL = _env('BOT_FLUSH_INTERVAL', 2.0, float)
+FLUSH_MAX_PENDING = _env('BOT_FLUSH_MAX_PENDING', 100, int)
+
+# Multiplier for the "typing..." pauses before the bot's replies; 0 sends them right away.
+TYPING_DELAY_SCALE = _env('BOT_TYPING_DELAY_SCALE', 1.0, float)
+
+# Telegram user ids allowed to run /report, /export and /import, comma-separated.
+ADMIN_IDS = _env('BOT_ADMIN_IDS', [], lambda value: [int(user_id) for user_id in value.split(',') if user_id.strip()])
+
+# Members shown on one /list page.
+LIST_PAGE_SIZE = _env('BOT_LIST_PAGE_SIZE', 20, int)
+
+# 'instant' pairs a user on /available with a random partner who's already waiting,
+# 'batch' pairs the whole pool every MATCH_INTERVAL seconds (see matchmaking.py).
+MATCH_MODE = _env('BOT_MATCH_MODE', 'instant')
+MATCH_INTERVAL = _env('BOT_MATCH_INTERVAL', 60.0, float)
+MATCH_TIME_BUDGET = _env('BOT_MATCH_TIME_BUDGET', 2.0, float)
+MATCH_CANDIDATES = _env('BOT_MATCH_CANDIDATES', 5, int)
+MATCH_MAX_EDGES = _env('BOT_MATCH_MAX_EDGES', 200000, int)
+# The cost of a pair: level and age differences make it worse, common hobbies better.
+MATCH_LEVEL_WEIGHT = _env('BOT_MATCH_LEVEL_WEIGHT', 3.0, float)
+MATCH_AGE_WEIGHT = _env('BOT_MATCH_AGE_WEIGHT', 0.5, float)
+MATCH_HOBBY_WEIGHT = _env('BOT_MATCH_HOBBY_WEIGHT', 5.0, float)
+# Partners aren't matched again within MATCH_COOLDOWN seconds of their last match (0 allows it
+# right away). Every match is recorded in HISTORY_PATH (see history.py).
+MATCH_COOLDOWN = _env('BOT_MATCH_COOLDOWN', 7 * 24 * 3600.0, float)
+HISTORY_PATH = _env('BOT_HISTORY_PATH', 'matches.log')
+
+# /available lasts AVAILABILITY_TTL seconds, after which the user is set busy (0 never expires).
+# AVAILABILITY_REMINDER seconds before that they're asked whether they're still there (0 doesn't ask).
+# The expirations are checked every AVAILABILITY_TICK seconds (see expiry.py).
+AVAILABILITY_TTL = _env('BOT_AVAILABILITY_TTL', 30 * 60.0, float)
+AVAILABILITY_REMINDER = _env('BOT_AVAILABILITY_REMINDER', 5 * 60.0, float)
+AVAILABILITY_TICK = _env('BOT_AVAILABILITY_TICK', 10.0, float)
+
+# Hobby similarity (see hobbies.py): /available picks among the HOBBY_TOP_K most similar
+# waiting users whose similarity is at least HOBBY_MIN_SIMILARITY. A query reads at most
+# HOBBY_MAX_POSTINGS entries of the inverted index.
+HOBBY_TOP_K = _env('BOT_HOBBY_TOP_K', 5, int)
+HOBBY_MIN_SIMILARITY = _env('BOT_HOBBY_MIN_SIMILARITY', 0.1, float)
+HOBBY_MAX_POSTINGS = _env('BOT_HOBBY_MAX_POSTINGS', 2000, int)
+
+# Outbound Bot API calls (see outbox.py). Telegram allows about 30 messages per second
+# overall and about one per second in a chat.
+OUTBOX_WORKERS = _env('BOT_OUTBOX_WORKERS', 4, int)
+OUTBOX_GLOBAL_RATE = _env('BOT_OUTBOX_GLOBAL_RATE', 30.0, float)
+OUTBOX_GLOBAL_BURST = _env('BOT_OUTBOX_GLOBAL_BURST', 30, int)
+OUTBOX_CHAT_RATE = _env('BOT_OUTBOX_CHAT_RATE', 1.0, float)
+OUTBOX_CHAT_BURST = _env('BOT_OUTBOX_CHAT_BURST', 3, int)
+OUTBOX_MAX_RETRIES = _env('BOT_OUTBOX_MAX_RETRIES', 3, int)
+
+# Logging (see logs.py). Only every LOG_DEBUG_SAMPLE_RATE-th DEBUG record with structured
+# payload fields is kept, and the fields are cut at LOG_MAX_FIELD_LENGTH characters.
+LOG_PATH = _env('BOT_LOG_PATH', 'debug.log')
+LOG_LEVEL = _env('BOT_LOG_LEVEL', 'DEBUG')
+LOG_DEBUG_SAMPLE_RATE = _env('BOT_LOG_DEBUG_SAMPLE_RATE', 1, int)
+LOG_MAX_FIELD_LENGTH = _env('BOT_LOG_MAX_FIELD_LENGTH', 500, int)
+
+# Prometheus metrics at http://METRICS_HOST:METRICS_PORT/metrics (see metrics.py); port 0 turns
+# the endpoint off. With PROFILE_SAMPLE_RATE = N > 0 every N-th handler call runs under cProfile
+# and the accumulated stats are written to PROFILE_PATH.
+METRICS_HOST = _env('BOT_METRICS_HOST', '127.0.0.1')
+METRICS_PORT = _env('BOT_METRICS_PORT', 9108, int)
+PROFILE_SAMPLE_RATE = _env('BOT_PROFILE_SAMPLE_RATE', 0, int)
+PROFILE_PATH = _env('BOT_PROFILE_PATH', 'handlers.prof')
+
+# 'polling' (getUpdates) or 'webhook': Telegram POSTs the updates to WEBHOOK_URL + '/' + WEBHOOK_SECRET,
+# which should reach the embedded server at WEBHOOK_LISTEN:WEBHOOK_PORT (see webhook.py). An empty
+# WEBHOOK_SECRET is replaced with a random one, and with an empty WEBHOOK_URL the webhook isn't
+# registered with Telegram, e.g. to POST recorded updates to the server locally.
+UPDATES_MODE = _env('BOT_UPDATES_MODE', 'polling')
+WEBHOOK_URL = _env('BOT_WEBHOOK_URL', '')
+WEBHOOK_LISTEN = _env('BOT_WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = _env('BOT_WEBHOOK_PORT', 8443, int)
+WEBHOOK_SECRET = _env('BOT_WEBHOOK_SECRET', '')
+WEBHOOK_MAX_CONNECTIONS = _env('BOT_WEBHOOK_MAX_CONNECTIONS', 40, int)
+WEBHOOK_MAX_BODY_SIZE = _env('BOT_WEBHOOK_MAX_BODY_SIZE', 1024 * 1024, int)
+WEBHOOK_QUEUE_SIZE = _env('BOT_WEBHOOK_QUEUE_SIZE', 1000, int)
+WEBHOOK_QUEUE_TIMEOUT = _env('BOT_WEBHOOK_QUEUE_TIMEOUT', 5.0, float)
+# A connection that sends nothing for WEBHOOK_TIMEOUT seconds, idle or mid-request, is closed.
+WEBHOOK_TIMEOUT = _env('BOT_WEBHOOK_TIMEOUT', 10.0, float)
+
+# Registration conversation states: an append-only CONVERSATIONS_PATH.journal compacted into
+# CONVERSATIONS_PATH.snapshot every CONVERSATIONS_SNAPSHOT_EVERY transitions (see conversations.py).
+# With CONVERSATIONS_FSYNC the journal survives power loss too, not only crashes, at an fsync per step.
+CONVERSATIONS_PATH = _env('BOT_CONVERSATIONS_PATH', 'conversations')
+CONVERSATIONS_SNAPSHOT_EVERY = _env('BOT_CONVERSATIONS_SNAPSHOT_EVERY', 1000, int)
+CONVERSATIONS_FSYNC = bool(_env('BOT_CONVERSATIONS_FSYNC', 0, int))
+
+# Worker processes of sharding.py, each owning the users with id % SHARDS == its index.
+# More than one needs the sqlite backend, which the workers share.
+SHARDS = _env('BOT_SHARDS', 1, int)
@@ -0,0 +1,147 @@
+import json
+import logging
+import os
+import threading
+from collections import defaultdict
+
+from telegram.ext import BasePersistence
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class JournalPersistence(BasePersistence):
+    """
+    Keeps the ConversationHandler states (and nothing else) in an append-only journal.
+
+    Every transition is appended to `path`.journal as a JSON line and flushed to the OS, so
+    it survives the process crashing. On shutdown, and once the journal has both at least
+    `snapshot_every` entries and at least as many entries as the conversation has states,
+    the current states are written to `path`.snapshot and the journal starts over. A restart
+    thus reads one snapshot of the conversations in flight plus a short journal instead of
+    the whole history, and the snapshots cost O(1) per entry however many states there are.
+    A torn last line of the journal is ignored.
+
+    `recover(name, conversations)`, if given, gets the loaded states of a conversation
+    before the handler does and returns the states to use, e.g. to rebuild them from other
+    persisted data when the journal is lost.
+    """
+
+    def __init__(self, path=config.CONVERSATIONS_PATH, snapshot_every=config.CONVERSATIONS_SNAPSHOT_EVERY,
+                 fsync=config.CONVERSATIONS_FSYNC, recover=None):
+        super().__init__(store_user_data=False, store_chat_data=False, store_bot_data=False)
+        self._snapshot_path = path + '.snapshot'
+        self._journal_path = path + '.journal'
+        self._snapshot_every = snapshot_every
+        self._fsync = fsync
+        self._recover = recover
+        self._lock = threading.Lock()
+        self._conversations, self._journaled = self._load()
+        self._journal = open(self._journal_path, 'a', encoding='utf-8')
+        if self._journal.tell():
+            # Appending after a torn entry would break the next one too.
+            self._snapshot()
+
+    def _load(self):
+        conversations = defaultdict(dict)
+        if os.path.exists(self._snapshot_path):
+            with open(self._snapshot_path, encoding='utf-8') as f:
+                # Columns parse much faster than a list of small lists.
+                for name, columns in json.load(f).items():
+                    conversations[name] = dict(zip(zip(*columns['keys']), columns['states']))
+
+        replayed = 0
+        if os.path.exists(self._journal_path):
+            with open(self._journal_path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        name, key, state = json.loads(line)
+                    except ValueError:
+                        logger.warning("JournalPersistence: skipping a torn journal entry")
+                        continue
+                    self._apply(conversations, name, tuple(key), state)
+                    replayed += 1
+
+        logger.info("JournalPersistence: loaded %s conversation states and %s journal entries",
+                    sum(len(states) for states in conversations.values()), replayed)
+        return conversations, replayed
+
+    @staticmethod
+    def _apply(conversations, name, key, state):
+        if state is None:
+            conversations[name].pop(key, None)
+        else:
+            conversations[name][key] = state
+
+    def _snapshot(self):
+        # Called with the lock held, or before any other thread can see the instance.
+        temporary_path = self._snapshot_path + '.tmp'
+        snapshot = {name: {'keys': [list(column) for column in zip(*states.keys())], 'states': list(states.values())}
+                    for name, states in self._conversations.items()}
+        with open(temporary_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(snapshot))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, self._snapshot_path)
+
+        # The snapshot covers the journal now. Should we crash before it's truncated, replaying
+        # it over the snapshot is harmless, since every entry is an absolute state.
+        self._journal.close()
+        self._journal = open(self._journal_path, 'w', encoding='utf-8')
+        self._journaled = 0
+
+    def get_conversations(self, name):
+        with self._lock:
+            conversations = dict(self._conversations[name])
+        if self._recover is not None:
+            conversations = self._recover(name, conversations)
+            with self._lock:
+                self._conversations[name] = dict(conversations)
+                self._snapshot()
+        return conversations
+
+    def update_conversation(self, name, key, new_state):
+        with self._lock:
+            if self._conversations[name].get(key) == new_state:
+                return
+            self._apply(self._conversations, name, key, new_state)
+
+            self._journal.write(json.dumps([name, list(key), new_state]) + '\n')
+            self._journal.flush()
+            if self._fsync:
+                os.fsync(self._journal.fileno())
+            self._journaled += 1
+            # Compacting once the journal outgrows the snapshot keeps the cost per transition constant.
+            if self._journaled >= max(self._snapshot_every, len(self._conversations[name])):
+                self._snapshot()
+
+    def flush(self):
+        # Updater calls this on a signal before it stops the dispatcher, so the journal stays open.
+        with self._lock:
+            self._snapshot()
+
+    def close(self):
+        with self._lock:
+            self._snapshot()
+            self._journal.close()
+
+    # Only the conversations are persisted.
+
+    def get_user_data(self):
+        return defaultdict(dict)
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def update_user_data(self, user_id, data):
+        pass
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
@@ -0,0 +1,76 @@
+import threading
+from collections import deque
+
+from telegram import ChatAction
+from telegram.ext import CallbackContext
+
+import config
+from outbox import Priority
+
+
+class DelayedSender:
+    """
+    Sends messages after a "typing..." pause without blocking the handler that asked for them.
+
+    Every chat has its own FIFO queue that is drained by JobQueue jobs: the head message gets
+    a typing indicator, waits for its delay and is handed to the outbox, then the next one is
+    started. This keeps the per-chat message order while the dispatcher threads return
+    immediately. A message without a delay in a chat with nothing queued goes straight to
+    the outbox.
+    """
+
+    def __init__(self, outbox, delay_scale=config.TYPING_DELAY_SCALE):
+        self._outbox = outbox
+        self._delay_scale = delay_scale
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    def send(self, context: CallbackContext, chat_id, delay=0, priority=Priority.REPLY, **kwargs):
+        self._enqueue(context, chat_id, delay, priority, context.bot.send_message, dict(chat_id=chat_id, **kwargs))
+
+    def reply(self, context: CallbackContext, message, text, delay=0, priority=Priority.REPLY, **kwargs):
+        self._enqueue(context, message.chat_id, delay, priority, message.reply_text, dict(text=text, **kwargs))
+
+    def pending(self, chat_id):
+        with self._lock:
+            return len(self._queues.get(chat_id, ()))
+
+    def _enqueue(self, context, chat_id, delay, priority, send, kwargs):
+        delay *= self._delay_scale
+        with self._lock:
+            queue = self._queues.get(chat_id)
+            idle = queue is None
+            if idle:
+                if delay <= 0:
+                    self._outbox.submit(chat_id, send, kwargs, priority)
+                    return
+                queue = self._queues[chat_id] = deque()
+            queue.append((delay, priority, send, kwargs))
+
+        if idle:
+            context.job_queue.run_once(self._start_head, 0, context=chat_id)
+
+    def _start_head(self, context: CallbackContext):
+        chat_id = context.job.context
+        with self._lock:
+            delay = self._queues[chat_id][0][0]
+
+        if delay <= 0:
+            self._deliver_head(context)
+            return
+
+        self._outbox.submit(chat_id, context.bot.send_chat_action, dict(chat_id=chat_id, action=ChatAction.TYPING),
+                            Priority.CHAT_ACTION)
+        context.job_queue.run_once(self._deliver_head, delay, context=chat_id)
+
+    def _deliver_head(self, context: CallbackContext):
+        chat_id = context.job.context
+        with self._lock:
+            queue = self._queues[chat_id]
+            _, priority, send, kwargs = queue.popleft()
+            self._outbox.submit(chat_id, send, kwargs, priority)
+            if not queue:
+                del self._queues[chat_id]
+                return
+
+        self._start_head(context)
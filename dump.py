@@ -0,0 +1,104 @@
+"""
+The user table as JSON Lines or CSV, written and read one user at a time.
+
+A JSONL line is a user document as it's stored. A CSV row has the USER_FIELDS columns
+and an `extra` column with the other fields as a JSON object; empty cells are None.
+"""
+import csv
+import json
+import os
+
+from levels import English_level_names
+from reports import STEPS, step_of
+from storage import USER_FIELDS
+
+FORMATS = ('jsonl', 'csv')
+
+_INTEGER_FIELDS = ('id', 'chat_id', 'level', 'age')
+_CSV_COLUMNS = USER_FIELDS + ('extra',)
+
+
+def format_of(path, default='jsonl'):
+    extension = os.path.splitext(path or '')[1].lstrip('.').lower()
+    return extension if extension in FORMATS else default
+
+
+def write_users(docs, file, format='jsonl'):
+    """Writes the `docs` to the text file `file` and returns how many there were."""
+    written = 0
+    if format == 'jsonl':
+        for doc in docs:
+            file.write(json.dumps(doc, ensure_ascii=False))
+            file.write('\n')
+            written += 1
+    elif format == 'csv':
+        writer = csv.writer(file)
+        writer.writerow(_CSV_COLUMNS)
+        for doc in docs:
+            extra = {key: value for key, value in doc.items() if key not in USER_FIELDS}
+            row = ['' if doc.get(field) is None else doc[field] for field in USER_FIELDS]
+            row[USER_FIELDS.index('available')] = int(bool(doc.get('available')))
+            row.append(json.dumps(extra, ensure_ascii=False) if extra else '')
+            writer.writerow(row)
+            written += 1
+    else:
+        raise ValueError("Unknown format '{}'".format(format))
+    return written
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _checked(doc, number):
+    if not isinstance(doc, dict) or not _is_int(doc.get('id')) or not _is_int(doc.get('chat_id')):
+        raise ValueError("Line {}: a user needs an integer id and chat_id".format(number))
+    doc = dict(dict.fromkeys(USER_FIELDS), **doc)
+    if doc['level'] is not None and (not _is_int(doc['level']) or doc['level'] not in range(len(English_level_names))):
+        raise ValueError("Line {}: the level must be one of 0..{} or empty".format(number, len(English_level_names) - 1))
+    if doc['age'] is not None and not _is_int(doc['age']):
+        raise ValueError("Line {}: the age must be an integer or empty".format(number))
+    # Questions are answered in order, and only registered users can be available.
+    step = step_of(doc)
+    if step is not None:
+        for field in STEPS[STEPS.index(step) + 1:]:
+            if doc[field] is not None:
+                raise ValueError("Line {}: the {} is given, but the {} isn't".format(number, field, step))
+    if doc['available'] not in (None, False, True):
+        raise ValueError("Line {}: available must be true, false, 1, 0 or empty".format(number))
+    doc['available'] = bool(doc['available'])
+    if doc['available'] and step is not None:
+        raise ValueError("Line {}: an unregistered user can't be available".format(number))
+    return doc
+
+
+def read_users(file, format='jsonl'):
+    """Yields the user documents of the text file `file`."""
+    if format == 'jsonl':
+        for number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            try:
+                doc = json.loads(line)
+            except ValueError as e:
+                raise ValueError("Line {}: {}".format(number, e)) from None
+            yield _checked(doc, number)
+    elif format == 'csv':
+        reader = csv.DictReader(file)
+        missing = set(USER_FIELDS) - set(reader.fieldnames or ())
+        if missing:
+            raise ValueError("Missing columns: {}".format(', '.join(sorted(missing))))
+        for row in reader:
+            doc = {field: row[field] if row[field] != '' else None for field in USER_FIELDS}
+            try:
+                for field in _INTEGER_FIELDS:
+                    if doc[field] is not None:
+                        doc[field] = int(doc[field])
+            except ValueError as e:
+                raise ValueError("Line {}: {}".format(reader.line_num, e)) from None
+            doc['available'] = doc['available'] not in (None, '0', 'false', 'False')
+            if row.get('extra'):
+                doc.update(json.loads(row['extra']))
+            yield _checked(doc, reader.line_num)
+    else:
+        raise ValueError("Unknown format '{}'".format(format))
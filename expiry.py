@@ -0,0 +1,139 @@
+import logging
+import threading
+import time
+
+from telegram.ext import CallbackContext
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel: a timer goes to the slot of its deadline's tick modulo `slots`.
+
+    Scheduling and cancelling are O(1), and advancing only looks at the slots of the ticks
+    that passed, so its cost follows the timers that are due (plus the ones a full turn of
+    the wheel or more away that share their slots) instead of all the timers.
+    """
+
+    def __init__(self, resolution, slots=512, now=None):
+        self._resolution = resolution
+        self._slots = [set() for _ in range(slots)]
+        self._deadlines = {}
+        self._tick = self._tick_of(time.time() if now is None else now)
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def _tick_of(self, when):
+        return int(when // self._resolution)
+
+    def schedule(self, key, when):
+        self.cancel(key)
+        self._deadlines[key] = when
+        # Overdue timers go to the current slot, which is the next one looked at.
+        self._slots[max(self._tick_of(when), self._tick) % len(self._slots)].add(key)
+
+    def cancel(self, key):
+        when = self._deadlines.pop(key, None)
+        if when is not None:
+            self._slots[max(self._tick_of(when), self._tick) % len(self._slots)].discard(key)
+
+    def advance(self, now):
+        """Removes and returns the keys of the timers due by `now`, the earliest first."""
+        last = self._tick_of(now)
+        due = []
+        # After a gap of a full turn or more, every slot is looked at once.
+        for tick in range(self._tick, min(last, self._tick + len(self._slots) - 1) + 1):
+            slot = self._slots[tick % len(self._slots)]
+            for key in [key for key in slot if self._deadlines[key] <= now]:
+                slot.discard(key)
+                due.append((self._deadlines.pop(key), key))
+
+        # What's left in the current slot is due later in this tick, so it's looked at again next time.
+        self._tick = max(self._tick, last)
+        return [key for _, key in sorted(due)]
+
+
+class AvailabilityExpiry:
+    """
+    Sets available users busy `ttl` seconds after their /available, as a JobQueue job.
+
+    The deadline is the user's `available_until` field, so it's persisted with the profile
+    and rebuild() restores the timers on startup from the one pass over the users the other
+    indexes make anyway. A UserRepository listener (track) keeps the timers in step with
+    the profiles, and every tick hands whoever is due to `remind(context, user_ids)`
+    `remind_before` seconds ahead and to `expire(context, user_ids)` at the deadline, in
+    one batch each.
+    """
+
+    def __init__(self, remind, expire, ttl=config.AVAILABILITY_TTL, remind_before=config.AVAILABILITY_REMINDER,
+                 resolution=config.AVAILABILITY_TICK):
+        self._remind = remind
+        self._expire = expire
+        self._ttl = ttl
+        self._remind_before = remind_before if 0 < remind_before < ttl else 0
+        self._resolution = resolution
+        self._wheel = TimerWheel(resolution)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._wheel)
+
+    def deadline(self):
+        """`available_until` for a user who is available from now on, None if availability doesn't expire."""
+        return time.time() + self._ttl if self._ttl > 0 else None
+
+    def _schedule(self, user_id, until):
+        self._wheel.schedule(('expire', user_id), until)
+        if self._remind_before and until - self._remind_before > time.time():
+            self._wheel.schedule(('remind', user_id), until - self._remind_before)
+        else:
+            self._wheel.cancel(('remind', user_id))
+
+    def _cancel(self, user_id):
+        self._wheel.cancel(('expire', user_id))
+        self._wheel.cancel(('remind', user_id))
+
+    def track(self, old, new):
+        """UserRepository listener."""
+        if new is not None and new['available']:
+            until = new.get('available_until')
+            # Without a deadline the timer of rebuild(), if any, stays.
+            if until is None or old is not None and old['available'] and old.get('available_until') == until:
+                return
+            with self._lock:
+                self._schedule(new['id'], until)
+        elif old is not None and old['available']:
+            with self._lock:
+                self._cancel(old['id'])
+
+    def rebuild(self, users):
+        with self._lock:
+            self._wheel = TimerWheel(self._resolution)
+            for user in users:
+                if user['available']:
+                    # Users who became available before availability expired get the whole ttl from now.
+                    until = user.get('available_until') or self.deadline()
+                    if until is not None:
+                        self._schedule(user['id'], until)
+
+    def run(self, context: CallbackContext):
+        started = time.monotonic()
+        with self._lock:
+            due = self._wheel.advance(time.time())
+        reminded = [user_id for kind, user_id in due if kind == 'remind']
+        expired = [user_id for kind, user_id in due if kind == 'expire']
+
+        if reminded:
+            self._remind(context, reminded)
+        if expired:
+            self._expire(context, expired)
+        if due:
+            logger.info("AvailabilityExpiry: reminded %s and expired %s users in %.3fs",
+                        len(reminded), len(expired), time.monotonic() - started)
@@ -0,0 +1,141 @@
+import logging
+import os
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class MatchHistory:
+    """
+    Who was matched with whom and when, to keep people from being paired again too soon.
+
+    Every user has a sorted array of their partners' ids and a parallel array of when they
+    last met, so checking a pair is a binary search over 16 bytes per partner, however many
+    partners there were. record() adds one side of a match: both users of a match are
+    recorded, each by the process that owns them (see sharding.py). Every record is also
+    appended to `path`, which is replayed on startup. Once it holds more records than there
+    are pairs, `path` is rewritten as one line per user with their match count and the last
+    time they met each partner.
+    """
+
+    def __init__(self, path=config.HISTORY_PATH, cooldown=config.MATCH_COOLDOWN):
+        self._path = path
+        self._cooldown = cooldown
+        self._partners = {}  # user id -> (partner ids, times), sorted by the partner id
+        self._counts = {}  # user id -> matches, repeated ones included
+        self._pairs = 0
+        self._matches = 0
+        self._repeats = 0
+        self._max_count = 0
+        self._logged = 0  # records appended to `path` since it was last rewritten
+        self._lock = threading.Lock()
+
+        line = '\n'
+        try:
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        if line.startswith('*'):
+                            self._load_user(line[1:].split())
+                            continue
+                        user_id, partner_id, when = line.split()
+                        self._add(int(user_id), int(partner_id), float(when))
+                    except ValueError:
+                        logger.warning("MatchHistory: skipping a torn record")
+                        continue
+                    self._logged += 1
+        except FileNotFoundError:
+            pass
+        self._file = open(path, 'a', encoding='utf-8')
+        if not line.endswith('\n'):
+            # Otherwise a torn last record would swallow the next one.
+            self._file.write('\n')
+        logger.info("MatchHistory: loaded %s matches of %s users", self._matches, len(self._partners))
+
+    def _load_user(self, fields):
+        """Loads a line of a rewritten `path`: '*user_id count partner_id time partner_id time ...'."""
+        user_id, count = int(fields[0]), int(fields[1])
+        partners = array('q', map(int, fields[2::2]))
+        times = array('d', map(float, fields[3::2]))
+        self._partners[user_id] = (partners, times)
+        self._counts[user_id] = count
+        self._pairs += len(partners)
+        self._matches += count
+        self._repeats += count - len(partners)
+        self._max_count = max(self._max_count, count)
+
+    def _add(self, user_id, partner_id, when):
+        partners, times = self._partners.setdefault(user_id, (array('q'), array('d')))
+        index = bisect_left(partners, partner_id)
+        if index < len(partners) and partners[index] == partner_id:
+            times[index] = when
+            self._repeats += 1
+        else:
+            partners.insert(index, partner_id)
+            times.insert(index, when)
+            self._pairs += 1
+        count = self._counts[user_id] = self._counts.get(user_id, 0) + 1
+        self._max_count = max(self._max_count, count)
+        self._matches += 1
+
+    def record(self, user_id, partner_id):
+        when = time.time()
+        with self._lock:
+            self._add(user_id, partner_id, when)
+            self._file.write('{} {} {:.3f}\n'.format(user_id, partner_id, when))
+            self._file.flush()
+            self._logged += 1
+            if self._logged > self._pairs:
+                self._compact()
+
+    def _compact(self):
+        # Called with the lock held. The rewritten file replaces the log in one step, so a crash
+        # leaves either of them and no record is replayed twice.
+        temporary_path = self._path + '.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as f:
+            for user_id, (partners, times) in self._partners.items():
+                f.write('*{} {}'.format(user_id, self._counts[user_id]))
+                for partner_id, when in zip(partners, times):
+                    f.write(' {} {:.3f}'.format(partner_id, when))
+                f.write('\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._file.close()
+        os.replace(temporary_path, self._path)
+        self._file = open(self._path, 'a', encoding='utf-8')
+        self._logged = 0
+
+    def met(self, user_id, partner_id):
+        """Whether the two were matched within the cool-down."""
+        entry = self._partners.get(user_id)
+        if entry is None:
+            return False
+        partners, times = entry
+        index = bisect_left(partners, partner_id)
+        return index < len(partners) and partners[index] == partner_id and times[index] > time.time() - self._cooldown
+
+    def matches(self, user_id):
+        return self._counts.get(user_id, 0)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'users': len(self._counts),
+                'matches': self._matches,
+                'matches_per_user': self._matches / len(self._counts) if self._counts else 0.0,
+                'max_matches': self._max_count,
+                'repeat_rate': self.repeat_rate(),
+            }
+
+    def repeat_rate(self):
+        """The share of the matches between people who had met before."""
+        return self._repeats / self._matches if self._matches else 0.0
+
+    def close(self):
+        with self._lock:
+            self._file.close()
@@ -0,0 +1,165 @@
+import heapq
+import math
+import re
+import threading
+from collections import Counter
+from itertools import islice
+from operator import itemgetter
+
+import config
+
+_WORD = re.compile(r'\w+')
+
+
+def ngrams(text, n=3):
+    """Character n-grams of the words of `text`; \\w matches Cyrillic as well as Latin letters."""
+    text = text.lower().replace('ё', 'е')
+    grams = Counter()
+    for word in _WORD.findall(text):
+        word = ' {} '.format(word)
+        for i in range(max(1, len(word) - n + 1)):
+            grams[word[i:i + n]] += 1
+    return grams
+
+
+class HobbyIndex:
+    """
+    TF-IDF vectors of character trigrams of the users' hobbies with an inverted index.
+
+    Vectors are weighted with the document frequencies at the time they're added and
+    L2-normalized, so a similarity is a sparse dot product. Every profile has a vector, but
+    only searchable users (the ones waiting for a partner) are in the inverted index, and a
+    query walks the postings of its rarest trigrams first and stops after `max_postings`
+    entries, so its cost is bounded no matter how many profiles there are.
+    """
+
+    def __init__(self, max_postings=config.HOBBY_MAX_POSTINGS):
+        self._max_postings = max_postings
+        self._vectors = {}
+        self._frequencies = Counter()
+        self._postings = {}
+        self._searchable = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._vectors)
+
+    def __contains__(self, user_id):
+        return user_id in self._vectors
+
+    @staticmethod
+    def _weigh(grams, documents, frequencies):
+        vector = {gram: (1 + math.log(count)) * (math.log(documents / (1 + frequencies[gram])) + 1)
+                  for gram, count in grams.items()}
+        norm = math.sqrt(sum(weight * weight for weight in vector.values())) or 1.0
+        return {gram: weight / norm for gram, weight in vector.items()}
+
+    def _index(self, user_id):
+        for gram, weight in self._vectors[user_id].items():
+            self._postings.setdefault(gram, {})[user_id] = weight
+
+    def _unindex(self, user_id):
+        for gram in self._vectors[user_id]:
+            posting = self._postings[gram]
+            del posting[user_id]
+            if not posting:
+                del self._postings[gram]
+
+    def _remove(self, user_id):
+        if user_id not in self._vectors:
+            return
+        if user_id in self._searchable:
+            self._unindex(user_id)
+        self._frequencies.subtract(self._vectors.pop(user_id).keys())
+
+    def add(self, user_id, text):
+        grams = ngrams(text)
+        with self._lock:
+            self._remove(user_id)
+            self._frequencies.update(grams.keys())
+            self._vectors[user_id] = self._weigh(grams, len(self._vectors) + 1, self._frequencies)
+            if user_id in self._searchable:
+                self._index(user_id)
+
+    def remove(self, user_id):
+        with self._lock:
+            self._remove(user_id)
+            self._searchable.discard(user_id)
+
+    def set_searchable(self, user_id, searchable):
+        with self._lock:
+            if searchable == (user_id in self._searchable):
+                return
+            if searchable:
+                self._searchable.add(user_id)
+                if user_id in self._vectors:
+                    self._index(user_id)
+            else:
+                self._searchable.discard(user_id)
+                if user_id in self._vectors:
+                    self._unindex(user_id)
+
+    def track(self, old, new):
+        """UserRepository listener: indexes saved hobbies and makes available users searchable."""
+        if new is None:
+            if old is not None:
+                self.remove(old['id'])
+            return
+        if new['hobbies'] is not None and (old is None or old['hobbies'] != new['hobbies']):
+            self.add(new['id'], new['hobbies'])
+        if old is None or old['available'] != new['available']:
+            self.set_searchable(new['id'], new['available'])
+
+    def rebuild(self, profiles, searchable=()):
+        """Indexes (user id, hobbies) pairs, weighting all of them with the final frequencies."""
+        grams = {user_id: ngrams(text) for user_id, text in profiles}
+        with self._lock:
+            self._frequencies = Counter(gram for user_grams in grams.values() for gram in user_grams)
+            self._vectors = {user_id: self._weigh(user_grams, len(grams), self._frequencies)
+                             for user_id, user_grams in grams.items()}
+            self._postings = {}
+            self._searchable = set(searchable)
+            for user_id in self._searchable & self._vectors.keys():
+                self._index(user_id)
+
+    def similarity(self, a, b):
+        a = self._vectors.get(a)
+        b = self._vectors.get(b)
+        if not a or not b:
+            return 0.0
+        if len(a) > len(b):
+            a, b = b, a
+        return sum(weight * b.get(gram, 0.0) for gram, weight in a.items())
+
+    def top_k(self, user_id, k, accept, min_similarity=config.HOBBY_MIN_SIMILARITY):
+        """
+        Returns up to `k` (user id, similarity) pairs of the searchable users most similar to
+        `user_id` that `accept(user id)` lets through, most similar first.
+        """
+        with self._lock:
+            query = self._vectors.get(user_id)
+            if not query:
+                return []
+            grams = sorted((gram for gram in query if gram in self._postings), key=lambda gram: len(self._postings[gram]))
+
+            scores = {}
+            budget = self._max_postings
+            for gram in grams:
+                query_weight = query[gram]
+                for other, weight in islice(self._postings[gram].items(), budget):
+                    scores[other] = scores.get(other, 0.0) + query_weight * weight
+                budget -= len(self._postings[gram])
+                if budget <= 0:
+                    break
+
+        # The scores are partial when the budget ran out, so the best candidates are rescored exactly.
+        scores.pop(user_id, None)
+        candidates = []
+        for other, _ in heapq.nlargest(len(scores), scores.items(), key=itemgetter(1)):
+            if len(candidates) >= 4 * k:
+                break
+            if accept(other):
+                candidates.append(other)
+
+        best = heapq.nlargest(k, ((other, self.similarity(user_id, other)) for other in candidates), key=itemgetter(1))
+        return [(other, score) for other, score in best if score >= min_similarity]
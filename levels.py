@@ -0,0 +1,16 @@
+# The English levels a user can pick, by their index in the profile's `level` field.
+English_levels = [
+    ('A1', "Elementary"),
+    ('A1+', "..."),
+    ('A2', "Pre Intermediate"),
+    ('A2+', "..."),
+    ('B1', "Intermediate"),
+    ('B1+', "..."),
+    ('B2', "Upper Intermediate"),
+    ('B2+', "..."),
+    ('C1', "Advanced"),
+    ('C1+', "..."),
+    ('C2', "Proficient"),
+]
+
+English_level_names = [item[0] for item in English_levels]
@@ -0,0 +1,83 @@
+import threading
+
+import config
+
+# Telegram refuses messages longer than this.
+MAX_MESSAGE_LENGTH = 4096
+
+
+class ListingCache:
+    """
+    Rendered /list pages, cached per filter.
+
+    A filter is a (level, available) pair where None means "any". The pages of a filter are
+    rendered once and kept until a change of a profile that is (or was) listed under it
+    alters the membership of the filter or how the profile is rendered.
+    """
+
+    def __init__(self, render_line, page_size=config.LIST_PAGE_SIZE, max_length=MAX_MESSAGE_LENGTH - 100):
+        self._render_line = render_line
+        self._page_size = page_size
+        self._max_length = max_length
+        self._pages = {}
+        self._generation = 0  # bumped on every invalidation, see pages()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def listed(user):
+        return user is not None and user['hobbies'] is not None
+
+    @classmethod
+    def matches(cls, user, level, available):
+        return cls.listed(user) and \
+            (level is None or user['level'] == level) and \
+            (available is None or user['available'] == available)
+
+    def pages(self, users, level=None, available=None):
+        key = (level, available)
+        with self._lock:
+            pages = self._pages.get(key)
+            generation = self._generation
+        if pages is not None:
+            return pages
+
+        pages = []
+        lines = []
+        length = 0
+        for user in users():
+            if not self.matches(user, level, available):
+                continue
+            line = self._render_line(user)
+            if lines and (len(lines) >= self._page_size or length + len(line) > self._max_length):
+                pages.append(''.join(lines))
+                lines = []
+                length = 0
+            lines.append(line)
+            length += len(line)
+        if lines:
+            pages.append(''.join(lines))
+
+        with self._lock:
+            # A profile changed while the pages were rendered from the users, so they may be stale.
+            if self._generation == generation:
+                self._pages[key] = pages
+        return pages
+
+    def invalidate(self, old, new):
+        """Drops the pages a change of a profile from `old` to `new` (None if absent) affects."""
+        if not self.listed(old) and not self.listed(new):
+            return
+        same_line = self.listed(old) and self.listed(new) and self._render_line(old) == self._render_line(new)
+
+        with self._lock:
+            self._generation += 1
+            for key in list(self._pages):
+                was_listed = self.matches(old, *key)
+                is_listed = self.matches(new, *key)
+                if was_listed != is_listed or (is_listed and not same_line):
+                    del self._pages[key]
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._pages.clear()
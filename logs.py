@@ -0,0 +1,98 @@
+import atexit
+import copy
+import itertools
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+import config
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)-8s - %(message)s'
+
+
+def kv(**fields):
+    """
+    Structured fields for a log record: logger.debug("...", extra=kv(user=user)).
+
+    They are rendered as key=value after the message by the listener thread, so a large
+    payload costs nothing on the calling thread and is truncated to LOG_MAX_FIELD_LENGTH.
+    """
+    return {'kv': fields}
+
+
+class KeyValueFormatter(logging.Formatter):
+    def __init__(self, fmt=LOG_FORMAT, max_field_length=config.LOG_MAX_FIELD_LENGTH):
+        super().__init__(fmt)
+        self._max_field_length = max_field_length
+
+    def _field(self, value):
+        text = str(value)
+        if len(text) > self._max_field_length:
+            text = '{}...({} chars)'.format(text[:self._max_field_length], len(text))
+        return text
+
+    def format(self, record):
+        message = super().format(record)
+        fields = getattr(record, 'kv', None)
+        if fields:
+            message += ' ' + ' '.join('{}={}'.format(key, self._field(value)) for key, value in fields.items())
+        return message
+
+
+class PayloadSampler(logging.Filter):
+    """Lets through only every `rate`-th DEBUG record that carries structured fields."""
+
+    def __init__(self, rate=config.LOG_DEBUG_SAMPLE_RATE):
+        super().__init__()
+        self._rate = max(1, rate)
+        self._counter = itertools.count()
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or not getattr(record, 'kv', None):
+            return True
+        return next(self._counter) % self._rate == 0
+
+
+class _QueueHandler(QueueHandler):
+    _exception_formatter = logging.Formatter()
+
+    def prepare(self, record):
+        # Only the message is merged here, so that the arguments are captured as they are now;
+        # timestamps, fields and the I/O are left to the listener thread.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self._exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging(path=config.LOG_PATH, level=config.LOG_LEVEL):
+    """
+    Routes all records through a queue to a listener thread that writes them to stderr and to
+    a rotating `path`, so no handler thread ever waits for the disk.
+    """
+    formatter = KeyValueFormatter()
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+
+    file_handler = RotatingFileHandler(path, mode='a', maxBytes=20*1024*1024, backupCount=2)
+    file_handler.setFormatter(formatter)
+
+    records = queue.SimpleQueue()
+    queue_handler = _QueueHandler(records)
+    queue_handler.addFilter(PayloadSampler())
+
+    root = logging.getLogger()
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    # Every request would be logged at DEBUG and every delayed reply (a JobQueue job) at INFO otherwise.
+    for library, library_level in (('telegram', logging.INFO), ('urllib3', logging.INFO), ('apscheduler', logging.WARNING)):
+        logging.getLogger(library).setLevel(max(library_level, logging.getLevelName(level)))
+
+    listener = QueueListener(records, stream_handler, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
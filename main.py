@@ -1,36 +1,35 @@
-from telegram import Update, ParseMode, ChatAction
-from telegram.ext import Updater, CommandHandler, CallbackContext, ConversationHandler,  MessageHandler, Filters
-from tinydb import TinyDB, Query, where
+from telegram import Update, ParseMode, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
+from telegram.ext import Updater, CommandHandler, CallbackContext, ConversationHandler,  MessageHandler, Filters, \
+    CallbackQueryHandler
 from enum import IntEnum, Enum
-from time import sleep
 import random
 import logging
-from logging.handlers import RotatingFileHandler
-from constants import TOKEN
-
-
-def get_logger(log_name=''):
-    log_format = '%(asctime)s - %(name)s - %(levelname)-8s - %(message)s'
-
-    log = logging.getLogger(log_name)
-    log_formatter = logging.Formatter(log_format)
-
-    stream_handler = logging.StreamHandler()
-    stream_handler.setFormatter(log_formatter)
-    log.addHandler(stream_handler)
-
-    file_handler_info = RotatingFileHandler('debug.log', mode='a', maxBytes=20*1024*1024, backupCount=2,
-                                            encoding=None, delay=0)
-    file_handler_info.setFormatter(log_formatter)
-    file_handler_info.setLevel(logging.DEBUG)
-    log.addHandler(file_handler_info)
-
-    log.setLevel(logging.DEBUG)
-
-    return log
-
-
-logger = get_logger(__name__)
+import os
+import tempfile
+import time
+from storage import open_storage
+from repository import UserRepository
+from pool import AvailabilityPool
+from outbox import Outbox, Priority
+from delayed import DelayedSender
+from listing import ListingCache
+from matchmaking import BatchMatcher
+from hobbies import HobbyIndex
+from expiry import AvailabilityExpiry
+from history import MatchHistory
+from levels import English_levels, English_level_names
+from reports import UserStats, render_report
+from dump import FORMATS, format_of, read_users, write_users
+from logs import setup_logging, kv
+import metrics
+from webhook import WebhookServer
+from conversations import JournalPersistence
+import config
+
+
+setup_logging()
+logger = logging.getLogger(__name__)
 
 
 class UserStates(IntEnum):
@@ -47,24 +46,56 @@ class DataState(IntEnum):
     ANSWER_GIVEN = 3
 
 
-English_levels = [
-    ('A1', "Elementary"),
-    ('A1+', "..."),
-    ('A2', "Pre Intermediate"),
-    ('A2+', "..."),
-    ('B1', "Intermediate"),
-    ('B1+', "..."),
-    ('B2', "Upper Intermediate"),
-    ('B2+', "..."),
-    ('C1', "Advanced"),
-    ('C1+', "..."),
-    ('C2', "Proficient"),
-]
-
 English_levels_str = "\n".join(["{} – {}".format(item[0], item[1]) for item in English_levels])
-English_level_names = [item[0] for item in English_levels]
 
-db = TinyDB('db.json')
+bot_metrics = metrics.BotMetrics()
+
+db = bot_metrics.storage(open_storage())
+users = UserRepository(db)
+
+pool = AvailabilityPool(len(English_level_names))
+pool.rebuild(users.all())
+
+outbox = Outbox(on_call=bot_metrics.api_call, on_delivered=bot_metrics.outbox_delivered)
+replies = DelayedSender(outbox)
+
+# render_member is defined below
+listing = ListingCache(lambda member: render_member(member))
+users.add_listener(listing.invalidate)
+
+hobby_index = HobbyIndex()
+hobby_index.rebuild(((user['id'], user['hobbies']) for user in users.all() if user['hobbies'] is not None),
+                    searchable=pool.user_ids())
+users.add_listener(hobby_index.track)
+
+user_stats = UserStats()
+user_stats.rebuild(users.all())
+users.add_listener(user_stats.track)
+
+# remind_available and expire_available are defined below
+expiry = AvailabilityExpiry(lambda context, user_ids: remind_available(context, user_ids),
+                            lambda context, user_ids: expire_available(context, user_ids))
+expiry.rebuild(users.all())
+users.add_listener(expiry.track)
+
+bot_metrics.gauge('bot_registered_users', 'Users in the DB.', lambda: len(users))
+bot_metrics.gauge('bot_pool_size', 'Users waiting for a partner.', lambda: len(pool))
+bot_metrics.gauge('bot_outbox_depth', 'Bot API calls waiting to be sent.', outbox.depth)
+bot_metrics.gauge('bot_availability_timers', 'Pending availability reminders and expirations.', lambda: len(expiry))
+
+# In a shard worker process (see sharding.py) the users of the other shards are replicas and
+# `shard` tells which users are owned and forwards events to the other shards.
+shard = None
+
+# recover_registrations is defined below
+persistence = JournalPersistence(recover=lambda name, conversations: recover_registrations(conversations))
+
+history = MatchHistory()
+bot_metrics.gauge('bot_match_repeat_rate', 'Share of the matches between people who had met before.', history.repeat_rate)
+
+# notify_match is defined below
+matcher = BatchMatcher(users, pool, lambda context, user, partner: notify_match(context, user, partner),
+                       similarity=hobby_index.similarity, excluded=history.met)
 
 
 def link_to_user(user_data):
@@ -77,6 +108,33 @@ def link_to_user(user_data):
     return link
 
 
+def parse_level(text):
+    return text.upper().replace('А', 'A').replace('В', 'B').replace('С', 'C')
+
+
+def render_member(member):
+    return link_to_user(member) + " | {} | {} y.o. \n".format(English_level_names[member['level']], member['age'])
+
+
+def render_list_page(level, available_, page):
+    pages = listing.pages(users.all, level, available_)
+    if not pages:
+        return 'Пока здесь никого нет 🤷🏻‍♂️', None
+
+    page = max(0, min(page, len(pages) - 1))
+    callback_data = 'list:{}:{}:'.format('' if level is None else level, '' if available_ is None else int(available_))
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton('◀️', callback_data=callback_data + str(page - 1)))
+    if page < len(pages) - 1:
+        buttons.append(InlineKeyboardButton('▶️', callback_data=callback_data + str(page + 1)))
+
+    text = pages[page]
+    if len(pages) > 1:
+        text += '\n{}/{}'.format(page + 1, len(pages))
+    return text, InlineKeyboardMarkup([buttons]) if buttons else None
+
+
 def logger_user_data(userid_or_instance, user_nick_name=None):
     if user_nick_name is None:
         uid = userid_or_instance['id']
@@ -86,36 +144,61 @@ def logger_user_data(userid_or_instance, user_nick_name=None):
         return "user(id={}, nick_name={})".format(userid_or_instance, user_nick_name)
 
 
+def registration_state(user):
+    """The registration step of a user with an incomplete profile, None for a complete one."""
+    for field, state in (('name', UserStates.NAME), ('level', UserStates.LEVEL),
+                         ('age', UserStates.AGE), ('hobbies', UserStates.HOBBIES)):
+        if user[field] is None:
+            return state
+    return None
+
+
+def owned(user_id) -> bool:
+    return shard is None or shard.owns(user_id)
+
+
+def recover_registrations(conversations):
+    # The profiles are written behind, so after a crash the journal can be ahead of them: the
+    # step of the first missing field wins, and users whose profile was lost start over.
+    recovered = {}
+    for key, state in conversations.items():
+        user = users.get(key[1])
+        if user is not None and registration_state(user) is not None:
+            recovered[key] = min(state, registration_state(user))
+    for user in users.all():
+        key = (user['chat_id'], user['id'])
+        if key not in recovered and owned(user['id']) and registration_state(user) is not None:
+            recovered[key] = registration_state(user)
+    return recovered
+
+
 def answered_all_questions(user_id) -> bool:
-    user_ = db.search(Query().id == user_id)
-    if not user_ or user_[0]['hobbies'] is None:
+    user_ = users.get(user_id)
+    if user_ is None or user_['hobbies'] is None:
         return False
     return True
 
 
 def start(update: Update, context: CallbackContext) -> UserStates:
     user = update.effective_user
-    logger.info("/start {} was called".format(logger_user_data(user)))
+    logger.info("/start %s was called", logger_user_data(user))
 
-    result = db.search(Query().id == update.effective_chat.id)
-    if result:
-        logger.info("/start {}: the user is already in the DB, asking if they want to recreate their form".format(logger_user_data(user)))
-        user = result[0]
-        context.bot.sendMessage(chat_id=update.effective_chat.id, text="{}, ты уже создал свою анкету, но если ты хочешь что-то изменить, то напиши /cancel, а потом перезапусти бота, чтобы зарегистрироваться заново – возможно, ты сменил имя или же свои взгляды 👀😆"
-                                .format(user['name']))
+    result = users.get(update.effective_user.id)
+    if result is not None:
+        logger.info("/start %s: the user is already in the DB, asking if they want to recreate their form", logger_user_data(user))
+        user = result
+        replies.send(context, chat_id=update.effective_chat.id, text="{}, ты уже создал свою анкету, но если ты хочешь что-то изменить, то напиши /cancel, а потом перезапусти бота, чтобы зарегистрироваться заново – возможно, ты сменил имя или же свои взгляды 👀😆"
+                              .format(user['name']))
 
+        metrics.mark('already_registered')
         return None
 
-    context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-    sleep(1.5)
-    context.bot.sendMessage(chat_id=update.effective_chat.id, text='Привет! 👋 \n\nЯ – Бот-помощник. '
-                                                                   'Меня создали для того, чтобы помочь тебе найти 🇺🇸 англоговорящего собеседника.')
-    context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-    sleep(2)
-    context.bot.sendMessage(chat_id=update.effective_chat.id, text='Как я могу к тебе обращатся? 🙃')
+    replies.send(context, chat_id=update.effective_chat.id, text='Привет! 👋 \n\nЯ – Бот-помощник. '
+                                                                 'Меня создали для того, чтобы помочь тебе найти 🇺🇸 англоговорящего собеседника.', delay=1.5)
+    replies.send(context, chat_id=update.effective_chat.id, text='Как я могу к тебе обращатся? 🙃', delay=2)
 
 
-    db.insert({
+    users.insert({
         'id': update.effective_user.id,
         'chat_id': update.effective_chat.id,
         'nick_name': update.effective_user.username,
@@ -126,305 +209,524 @@ def start(update: Update, context: CallbackContext) -> UserStates:
         'available': False,
     })
 
-    logger.info("/start {}: the user data was inserted in the DB".format(logger_user_data(user)))
+    logger.info("/start %s: the user data was inserted in the DB", logger_user_data(user))
     return UserStates.NAME
 
 
 def name_handler(update: Update, context: CallbackContext) -> UserStates:
-    user = db.search(Query().id == update.effective_user.id)[0]
+    user = users.get(update.effective_user.id)
 
-    logger.info("name_handler: {} is about to enter their name".format(logger_user_data(user)))
+    logger.info("name_handler: %s is about to enter their name", logger_user_data(user))
 
     name = update.message.text
-    logger.info("name_handler: {} entered '{}' as their name".format(logger_user_data(user), name))
+    logger.info("name_handler: %s entered '%s' as their name", logger_user_data(user), name)
 
     if name.startswith('/'):
-        update.message.reply_text('Тебя действительно зовут {}? 😅\n\nДавай еще раз:'.format(name))
-        logger.info("name_handler: {} the name '{}' is invalid and the user is asked to enter another one"
-                    .format(logger_user_data(user), name))
+        replies.reply(context, update.message, 'Тебя действительно зовут {}? 😅\n\nДавай еще раз:'.format(name))
+        logger.info("name_handler: %s the name '%s' is invalid and the user is asked to enter another one",
+                    logger_user_data(user), name)
+        metrics.mark('validation_retry')
         return UserStates.NAME
 
-    db.update({'name': name}, Query().id == update.effective_user.id)
-    logger.info("name_handler: {} their name '{}' is added into the DB".format(logger_user_data(user), name))
+    users.update(update.effective_user.id, {'name': name})
+    logger.info("name_handler: %s their name '%s' is added into the DB", logger_user_data(user), name)
 
     # TODO: let this be a menu and add suggestions if a user doesn't know their level.
-    context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-    sleep(1.5)
-    context.bot.sendMessage(chat_id=update.effective_chat.id, text='Очень приятно 🤝\n\n{}, скажи, какой у тебя уровень '
-                                                                   '🇺🇸?'.format(name))
+    replies.send(context, chat_id=update.effective_chat.id, text='Очень приятно 🤝\n\n{}, скажи, какой у тебя уровень '
+                                                                 '🇺🇸?'.format(name), delay=1.5)
 
-    logger.info("name_handler: {} is asked to enter their English level"
-                .format(logger_user_data(user)))
+    logger.info("name_handler: %s is asked to enter their English level",
+                logger_user_data(user))
     return UserStates.LEVEL
 
 
 def level_handler(update: Update, context: CallbackContext) -> UserStates:
-    user = db.search(Query().id == update.effective_user.id)[0]
-    level_ = update.message.text.upper().replace('А', 'A').replace('В', 'B').replace('С', 'C')
+    user = users.get(update.effective_user.id)
+    level_ = parse_level(update.message.text)
 
     if level_ not in English_level_names:
         logger.info(
-            "level_handler: {} the entered level '{}' is invalid, so the user is asked to enter it again"
-            .format(logger_user_data(user), level_))
-        context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-        sleep(1.5)
-        update.message.reply_text("Я тебя не понимаю 🤷🏻‍♂️... Попробуй выбрать из этих:\n" + English_levels_str)
+            "level_handler: %s the entered level '%s' is invalid, so the user is asked to enter it again",
+            logger_user_data(user), level_)
+        replies.reply(context, update.message, "Я тебя не понимаю 🤷🏻‍♂️... Попробуй выбрать из этих:\n" + English_levels_str, delay=1.5)
+        metrics.mark('validation_retry')
         return UserStates.LEVEL
 
     level = English_level_names.index(level_)
 
 
-    db.update({'level': level}, Query().id == user['id'])
-    logger.info("level_handler: {} entered their level to be '{}' and it was replaced to '{}'"
-                .format(logger_user_data(user), level_, level))
+    users.update(user['id'], {'level': level})
+    logger.info("level_handler: %s entered their level to be '%s' and it was replaced to '%s'",
+                logger_user_data(user), level_, level)
 
     name = user['name']
-    context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-    sleep(1.5)
-    context.bot.sendMessage(chat_id=update.effective_chat.id, text='Отлично ✨ \n\nА теперь, {}, скажи, сколько тебе лет?'
-                            .format(name))
-    logger.info("level_handler: {} is asked to enter their age".format(logger_user_data(user)))
+    replies.send(context, chat_id=update.effective_chat.id, text='Отлично ✨ \n\nА теперь, {}, скажи, сколько тебе лет?'
+                          .format(name), delay=1.5)
+    logger.info("level_handler: %s is asked to enter their age", logger_user_data(user))
 
     return UserStates.AGE
 
 
 def age_handler(update: Update, context: CallbackContext) -> None:
-    user = db.search(Query().id == update.effective_chat.id)[0]
+    user = users.get(update.effective_user.id)
     age = update.message.text
 
     if not age.isnumeric() or int(age) <= 0 or int(age) > 120:
         logger.info(
-            "age_handler: {} entered invalid age ('{}') and was asked to enter it again"
-            .format(logger_user_data(user), age)
+            "age_handler: %s entered invalid age ('%s') and was asked to enter it again",
+            logger_user_data(user), age
         )
 
-        context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-        sleep(1.5)
-        update.message.reply_text(
+        replies.reply(
+            context, update.message,
             "{}, тебе действительно {} лет? Что-то не вериться... \n\nДавай еще раз попробуем 😉"
-            .format(user['name'], age))
+            .format(user['name'], age), delay=1.5)
+        metrics.mark('validation_retry')
         return UserStates.AGE
 
-    db.update({'age': int(age)}, Query().id == update.effective_user.id)
+    users.update(update.effective_user.id, {'age': int(age)})
     logger.info(
-        "age_handler: {} entered their age to be '{}'".format(logger_user_data(user), age))
+        "age_handler: %s entered their age to be '%s'", logger_user_data(user), age)
 
     name = user['name']
-    context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-    sleep(1.5)
-    context.bot.sendMessage(chat_id=update.effective_chat.id, text='Вау! Осталось чуть-чуть! 🔥 \n\n'
-                                                                   '{}, расскажи, чем ты увлекаешься и что тебе интересно?'
-                            .format(name))
+    replies.send(context, chat_id=update.effective_chat.id, text='Вау! Осталось чуть-чуть! 🔥 \n\n'
+                                                                 '{}, расскажи, чем ты увлекаешься и что тебе интересно?'
+                          .format(name), delay=1.5)
     logger.info(
-        "level_handler: {} was asked to enter their hobbies".format(logger_user_data(user))
+        "level_handler: %s was asked to enter their hobbies", logger_user_data(user)
     )
 
     return UserStates.HOBBIES
 
 
 def hobbies_handler(update: Update, context: CallbackContext) -> UserStates:
-    user = db.search(Query().id == update.effective_user.id)[0]
+    user = users.get(update.effective_user.id)
     hobbies = update.message.text
 
     if hobbies.startswith("/"):
-        logger.info("hobbies_handler: {} entered the {} command instead of their hobbies".format(logger_user_data(user), hobbies))
-        context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-        sleep(1.5)
-        context.bot.sendMessage(chat_id=update.effective_chat.id, text='{}, ты действительно увлекаешься {}? 🤯\n\n'
-                                                                       'Мне, например, нравится смотреть на голубей – их шаболоны поведения напоминают мне логическое отображение x → rx(1 — x). 🧐'
-                                                                       '\n\nА что нравится делать тебе?'
-                                .format(user['name'], hobbies))
+        logger.info("hobbies_handler: %s entered the %s command instead of their hobbies", logger_user_data(user), hobbies)
+        replies.send(context, chat_id=update.effective_chat.id, text='{}, ты действительно увлекаешься {}? 🤯\n\n'
+                                                                     'Мне, например, нравится смотреть на голубей – их шаболоны поведения напоминают мне логическое отображение x → rx(1 — x). 🧐'
+                                                                     '\n\nА что нравится делать тебе?'
+                              .format(user['name'], hobbies), delay=1.5)
+        metrics.mark('validation_retry')
         return UserStates.HOBBIES
 
-    db.update({'hobbies': hobbies}, Query().id == update.effective_user.id)
+    users.update(update.effective_user.id, {'hobbies': hobbies})
 
     logger.info(
-        "hobbies_handler: {} entered their hobbies to be '{}'".format(logger_user_data(user), hobbies))
+        "hobbies_handler: %s entered their hobbies to be '%s'", logger_user_data(user), hobbies)
     logger.info(
-        "hobbies_handler: {} was suggested to run /available command".format(logger_user_data(user)))
+        "hobbies_handler: %s was suggested to run /available command", logger_user_data(user))
 
-    context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-    sleep(1.5)
-    context.bot.sendMessage(chat_id=update.effective_chat.id, text='Готово! Ты составил свою анкету! 🏁\n\n'
-                                                                   'Дальше пиши /available, когда есть свободная минутка '
-                                                            'и ты готов с кем-то 🗣 поговорить.\n\nКак говорил Альфонс Алле:\n„Не будь болваном. Никогда не откладывай на завтра то, что можешь сделать послезавтра“ 😉')
-    return UserStates.HOBBIES + 1
+    replies.send(context, chat_id=update.effective_chat.id, text='Готово! Ты составил свою анкету! 🏁\n\n'
+                                                                 'Дальше пиши /available, когда есть свободная минутка '
+                                                          'и ты готов с кем-то 🗣 поговорить.\n\nКак говорил Альфонс Алле:\n„Не будь болваном. Никогда не откладывай на завтра то, что можешь сделать послезавтра“ 😉', delay=1.5)
+    return ConversationHandler.END
 
 
 # TODO: ask confirmation via button and print warning
-def cancel(update: Update, context: CallbackContext) -> None:
-    before_deletion = db.search(Query().id == update.effective_user.id)
+def cancel(update: Update, context: CallbackContext) -> int:
+    before_deletion = users.get(update.effective_user.id)
 
     # check if the user wasn't in the DB
-    if not before_deletion:
-        logger.info("cancel: {} called /cancel not being themself in the DB"
-                    .format(logger_user_data(update.effective_user.id, update.effective_user.username)))
-        context.bot.sendMessage(chat_id=update.effective_chat.id, text="Ты не можешь использовать эту команду, пока не ответишь на все вопросы 😉")
-        return
+    if before_deletion is None:
+        logger.info("cancel: %s called /cancel not being themself in the DB",
+                    logger_user_data(update.effective_user.id, update.effective_user.username))
+        replies.send(context, chat_id=update.effective_chat.id, text="Ты не можешь использовать эту команду, пока не ответишь на все вопросы 😉")
+        metrics.mark('not_registered')
+        return ConversationHandler.END
 
-    user = before_deletion[0]
+    user = before_deletion
 
-    logger.info("cancel: {} called /cancel command".format(logger_user_data(user)))
-    logger.debug("cancel: {} called /cancel and their data was: {}"
-                 .format(logger_user_data(user), str(before_deletion)))
+    logger.info("cancel: %s called /cancel command", logger_user_data(user))
+    logger.debug("cancel: %s called /cancel, their data before the deletion",
+                 logger_user_data(user), extra=kv(data=before_deletion))
 
-    db.remove(where('id') == update.effective_user.id)
-    after_deletion = db.search(Query().id == update.effective_user.id)
+    users.remove(update.effective_user.id)
+    pool.discard(update.effective_user.id)
+    after_deletion = users.get(update.effective_user.id)
 
-    logger.debug("cancel: {} called /cancel and now their data in the DB is: {}"
-                 .format(logger_user_data(user), str(after_deletion)))
+    logger.debug("cancel: %s called /cancel, their data in the DB now",
+                 logger_user_data(user), extra=kv(data=after_deletion))
 
-    context.bot.sendMessage(chat_id=update.effective_chat.id, text='Я удалил все записи о тебе 🗑')
+    replies.send(context, chat_id=update.effective_chat.id, text='Я удалил все записи о тебе 🗑')
+    return ConversationHandler.END
 
 
 def available(update: Update, context: CallbackContext) -> None:
     # TODO: refactor
     if not answered_all_questions(update.effective_user.id):
-        logger.info("available: user(id={}, nick_name={}) didn't answer all questions, but called /available"
-                    .format(update.effective_user.id, update.effective_user.username))
-        context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-        sleep(1)
-        context.bot.sendMessage(chat_id=update.effective_chat.id,
-                                text='Ты не можешь начать поиск, пока не ответишь на все вопросы 😉')
+        logger.info("available: user(id=%s, nick_name=%s) didn't answer all questions, but called /available",
+                    update.effective_user.id, update.effective_user.username)
+        replies.send(context, chat_id=update.effective_chat.id,
+                              text='Ты не можешь начать поиск, пока не ответишь на все вопросы 😉', delay=1)
+        metrics.mark('not_registered')
         return None
 
-    user = db.search(Query().id == update.effective_user.id)[0]
+    user = users.get(update.effective_user.id)
 
     if user['available']:
-        logger.info("available: user(id={}, nick_name={}) is already available, but called again /available"
-                    .format(update.effective_user.id, update.effective_user.username))
-        context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-        sleep(1)
-        context.bot.sendMessage(chat_id=update.effective_chat.id,
-                                text='Не нужно злоупотреблять командами! 🤨\n\n'
-                                     'Общайтесь! Професионалами в любом деле становятся только через кровь, пот и слёзы.\n\n'
-                                     'Так что, {}, перебори свой страх стеснения, если Английский для тебя не пустое место 😎'.format(user['name']))
+        logger.info("available: user(id=%s, nick_name=%s) is already available, but called again /available",
+                    update.effective_user.id, update.effective_user.username)
+        replies.send(context, chat_id=update.effective_chat.id,
+                              text='Не нужно злоупотреблять командами! 🤨\n\n'
+                                   'Общайтесь! Професионалами в любом деле становятся только через кровь, пот и слёзы.\n\n'
+                                   'Так что, {}, перебори свой страх стеснения, если Английский для тебя не пустое место 😎'.format(user['name']), delay=1)
+        metrics.mark('already_available')
         return None
 
-    available_partners_ = db.search(Query().available == True)
-    available_partners = [p for p in available_partners_ if p['id'] != update.effective_user.id]
-    logger.info("available: {} called /available".format(logger_user_data(user)))
-    logger.debug("available: ALL (including with different level) available partners for {} are: {}"
-                 .format(logger_user_data(user), [logger_user_data(p) for p in available_partners]))
-
-    db.update({'available': True}, Query().id == update.effective_user.id)
-    context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-    sleep(1)
-    context.bot.sendMessage(chat_id=update.effective_chat.id, text='Ты установил свой статус на 🏝 "доступен".'
-                                                                   '\n\nЕсли твои планы, к несчастью, поменяются, ты всегда можешь написать /busy, чтобы прекратить поиск 😏')
-
-    partner = None
-    if available_partners:
-        level = db.search(Query().id == update.effective_user.id)[0]['level']
-        level_range = (max(0, level - 3), min(10, level + 3))
-
-        # TODO: exclude visited partners so that they're chosen more "randomly".
-        near_same_level_available_partners = []
-        for p in available_partners:
-            if level_range[0] <= p['level'] <= level_range[1]:
-                near_same_level_available_partners.append(p)
-        partner = random.choice(near_same_level_available_partners or [None])
-
-        logger.debug("available: available partners for {} are: {}; the chosen one: {}"
-                     .format(logger_user_data(user), [logger_user_data(p) for p in near_same_level_available_partners],
-                             logger_user_data(partner) if partner is not None else None))
+    logger.info("available: %s called /available", logger_user_data(user))
+
+    users.update(update.effective_user.id, {'available': True, 'available_until': expiry.deadline()})
+    replies.send(context, chat_id=update.effective_chat.id, text='Ты установил свой статус на 🏝 "доступен".'
+                                                                 '\n\nЕсли твои планы, к несчастью, поменяются, ты всегда можешь написать /busy, чтобы прекратить поиск 😏', delay=1)
+
+    if config.MATCH_MODE == 'batch':
+        pool.add(user['id'], user['level'])
+        logger.info("available: %s joined the pool of %s users waiting for the next batch match",
+                    logger_user_data(user), len(pool))
+        replies.send(context, chat_id=update.effective_chat.id, text='Когда я найду тебе собеседника, я дам тебе знать'
+                                                                 ' – жди сигнала 🔔!', delay=1)
+        return None
+
+    def allowed(user_id):
+        return not history.met(user['id'], user_id)
+
+    similar = hobby_index.top_k(user['id'], config.HOBBY_TOP_K,
+                                lambda user_id: pool.within(user_id, user['level']) and allowed(user_id))
+    if similar:
+        partner_id = random.choice(similar)[0]
+    else:
+        partner_id = pool.choice(user['level'], exclude=user['id'], allowed=allowed)
+    pool.add(user['id'], user['level'])
+    partner = users.get(partner_id) if partner_id is not None else None
+
+    logger.debug("available: %s available users are in the pool, %s of them have similar hobbies; the chosen partner for %s: %s",
+                 len(pool), len(similar), logger_user_data(user), logger_user_data(partner) if partner is not None else None)
 
     if not partner:
-        logger.info("available: {} called /available and no partner was found for them".format(logger_user_data(user)))
-        context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-        sleep(1)
-        context.bot.sendMessage(chat_id=update.effective_chat.id, text='Когда я найду тебе собеседника, я дам тебе знать'
-                                                                   ' – жди сигнала 🔔!')
+        logger.info("available: %s called /available and no partner was found for them", logger_user_data(user))
+        replies.send(context, chat_id=update.effective_chat.id, text='Когда я найду тебе собеседника, я дам тебе знать'
+                                                                 ' – жди сигнала 🔔!', delay=1)
     else:
-        context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-        sleep(1.5)
-        text = 'Я нашел тебе собеседника! 😎\n\nЕго зовут {}, ему {}, уровень – {}, ' \
-               'увлечения:\n{}\n\nБудь смелее и сделай первый шаг!'
+        notify_match(context, user, partner)
+
 
-        context.bot.sendMessage(chat_id=update.effective_chat.id,
-                                text=text.format(link_to_user(partner), partner['age'],
-                                                 English_level_names[partner['level']], partner['hobbies']),
-                                parse_mode=ParseMode.HTML)
+def send_match(context: CallbackContext, user, partner, delay=0) -> None:
+    # Called once for either side of a match, by the process that owns `user`.
+    history.record(user['id'], partner['id'])
 
-        me = db.search(Query().id == update.effective_user.id)[0]
-        context.bot.sendMessage(chat_id=partner['chat_id'],
-                                text=text.format(link_to_user(me), me['age'], English_level_names[me['level']], me['hobbies']),
-                                parse_mode=ParseMode.HTML)
+    text = 'Я нашел тебе собеседника! 😎\n\nЕго зовут {}, ему {}, уровень – {}, ' \
+           'увлечения:\n{}\n\nБудь смелее и сделай первый шаг!'
+
+    replies.send(context, chat_id=user['chat_id'],
+                 text=text.format(link_to_user(partner), partner['age'],
+                                  English_level_names[partner['level']], partner['hobbies']),
+                 parse_mode=ParseMode.HTML, priority=Priority.MATCH, delay=delay)
+
+
+def notify_match(context: CallbackContext, user, partner) -> None:
+    send_match(context, user, partner, delay=1.5)
+    if owned(partner['id']):
+        send_match(context, partner, user)
+    else:
+        # Every chat is written to only by the worker that owns its user.
+        shard.send(partner['id'], 'notify', partner['id'], user['id'])
+
+    logger.info("notify_match: %s and %s were matched", logger_user_data(user), logger_user_data(partner))
 
 
 def list_handler(update: Update, context: CallbackContext) -> None:
     if not answered_all_questions(update.effective_user.id):
-        logger.info("list: user(id={}, nick_name={}) didn't answer all questions, but called /list"
-                    .format(update.effective_user.id, update.effective_user.username))
-        context.bot.sendMessage(chat_id=update.effective_chat.id,
-                                text='Ты не можешь использовать эту комманду, пока не ответишь на все вопросы 😉')
+        logger.info("list: user(id=%s, nick_name=%s) didn't answer all questions, but called /list",
+                    update.effective_user.id, update.effective_user.username)
+        replies.send(context, chat_id=update.effective_chat.id,
+                              text='Ты не можешь использовать эту комманду, пока не ответишь на все вопросы 😉')
+        metrics.mark('not_registered')
         return None
 
-    user = db.search(Query().id == update.effective_user.id)[0]
+    user = users.get(update.effective_user.id)
+
+    level = None
+    available_ = None
+    for arg in context.args or []:
+        if parse_level(arg) in English_level_names:
+            level = English_level_names.index(parse_level(arg))
+        elif arg.lower() in ('available', 'доступные'):
+            available_ = True
+        else:
+            logger.info("list_handler: %s called /list with an unknown filter '%s'", logger_user_data(user), arg)
+            replies.send(context, chat_id=update.effective_chat.id,
+                         text='Я не знаю такого фильтра 🤔\n\nМожно указать уровень и/или "available", например:\n'
+                              '/list B1 available')
+            metrics.mark('validation_retry')
+            return None
+
+    text, reply_markup = render_list_page(level, available_, 0)
+
+    logger.info("list_handler: %s called /list with level=%s, available=%s", logger_user_data(user), level, available_)
 
-    logger.info("list_handler: {} called /list".format(logger_user_data(user)))
+    replies.send(context, chat_id=update.effective_chat.id, text=text, parse_mode=ParseMode.HTML, disable_web_page_preview = False,
+                 reply_markup=reply_markup, delay=1)
 
-    text = ""
-    for member in db.all():
-        link = link_to_user(member)
-        text += link + " | {} | {} y.o. \n".format(English_level_names[member['level']], member['age'])
 
-    logger.debug("list_handler: {} called /list and the result is: {}".format(logger_user_data(user),
-                                                                              text.replace('\n', '; ')))
+def list_page_handler(update: Update, context: CallbackContext) -> None:
+    query = update.callback_query
+    _, level, available_, page = query.data.split(':')
+    level = int(level) if level else None
+    available_ = bool(int(available_)) if available_ else None
 
-    context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-    sleep(1)
-    context.bot.sendMessage(chat_id=update.effective_chat.id, text=text, parse_mode=ParseMode.HTML, disable_web_page_preview = False)
+    text, reply_markup = render_list_page(level, available_, int(page))
+    logger.info("list_page_handler: %s opened /list page %s (level=%s, available=%s)",
+                logger_user_data(update.effective_user), page, level, available_)
+
+    def edit_message():
+        try:
+            query.edit_message_text(text=text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+        except BadRequest as e:
+            # The page is already shown, e.g. after a double tap.
+            if 'not modified' not in str(e):
+                raise
+
+    query.answer()
+    outbox.submit(query.message.chat_id, edit_message, {})
 
 
 def busy(update: Update, context: CallbackContext) -> None:
     if not answered_all_questions(update.effective_user.id):
-        logger.info("busy: user(id={}, nick_name={}) didn't answer all questions, but called /busy"
-                    .format(update.effective_user.id, update.effective_user.username))
-        context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-        sleep(1)
-        context.bot.sendMessage(chat_id=update.effective_chat.id,
-                                text='Ты не можешь использовать эту комманду, пока не ответишь на все вопросы 😉')
+        logger.info("busy: user(id=%s, nick_name=%s) didn't answer all questions, but called /busy",
+                    update.effective_user.id, update.effective_user.username)
+        replies.send(context, chat_id=update.effective_chat.id,
+                              text='Ты не можешь использовать эту комманду, пока не ответишь на все вопросы 😉', delay=1)
+        metrics.mark('not_registered')
         return None
 
-    user = db.search(Query().id == update.effective_user.id)[0]
+    user = users.get(update.effective_user.id)
+
+    logger.info("busy: %s called /busy", logger_user_data(user))
+
+    users.update(update.effective_user.id, {'available': False})
+    pool.discard(update.effective_user.id)
+
+    replies.send(context, chat_id=update.effective_chat.id, text='Ты установил свой статус на 🏋️‍♂️ "недоступен".\n\nКак только у тебя снова появится минутка, пиши /available и я подберу тебе собеседника\n\nP.S. «Если сможете совершенствоваться всего на 1% каждый день в течение одного года, к концу этого периода вы станете в 37 раз лучше самого себя», – Джеймс Клир, «Атомные привычки» 😉', delay=1)
 
-    logger.info("busy: {} called /busy".format(logger_user_data(user)))
 
-    db.update({'available': False}, Query().id == update.effective_user.id)
+def stats_handler(update: Update, context: CallbackContext) -> None:
+    if not answered_all_questions(update.effective_user.id):
+        logger.info("stats: user(id=%s, nick_name=%s) didn't answer all questions, but called /stats",
+                    update.effective_user.id, update.effective_user.username)
+        replies.send(context, chat_id=update.effective_chat.id,
+                              text='Ты не можешь использовать эту комманду, пока не ответишь на все вопросы 😉')
+        metrics.mark('not_registered')
+        return None
+
+    user = users.get(update.effective_user.id)
+    # In a shard worker these are the figures of the shard's users, a sample of everyone by id.
+    stats = history.stats()
+    logger.info("stats_handler: %s called /stats", logger_user_data(user))
+
+    replies.send(context, chat_id=update.effective_chat.id, delay=1,
+                 text='📊 Статистика встреч\n\n'
+                      'Твоих встреч: {}\n'
+                      'В среднем встреч на человека: {:.1f} (максимум – {})\n'
+                      'Повторных встреч: {:.0%}'.format(history.matches(user['id']), stats['matches_per_user'],
+                                                        stats['max_matches'], stats['repeat_rate']))
+
+
+def remind_available(context: CallbackContext, user_ids) -> None:
+    reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton('Я тут 🙋', callback_data='extend')]])
+    for user_id in filter(owned, user_ids):
+        user = users.get(user_id)
+        if user is None or not user['available']:
+            continue
+        logger.info("remind_available: %s was asked whether they're still looking for a partner", logger_user_data(user))
+        replies.send(context, chat_id=user['chat_id'], reply_markup=reply_markup,
+                     text='Ты ещё ищешь собеседника? 🧐\n\nЧерез {} мин. я установлю твой статус на 🏋️‍♂️ "недоступен". '
+                          'Нажми на кнопку, если хочешь продолжить поиск'.format(round(config.AVAILABILITY_REMINDER / 60)))
+
+
+def expire_available(context: CallbackContext, user_ids) -> None:
+    now = time.time()
+    for user_id in filter(owned, user_ids):
+        user = users.get(user_id)
+        # The deadline could have been moved while the job was waiting for the lock.
+        if user is None or not user['available'] or (user.get('available_until') or now) > now:
+            continue
+        logger.info("expire_available: %s was set busy after waiting for a partner too long", logger_user_data(user))
+        users.update(user_id, {'available': False})
+        pool.discard(user_id)
+        replies.send(context, chat_id=user['chat_id'],
+                     text='Я установил твой статус на 🏋️‍♂️ "недоступен", чтобы никто не ждал тебя зря.\n\n'
+                          'Как только у тебя снова появится минутка, пиши /available 😉')
+
+
+def extend_handler(update: Update, context: CallbackContext) -> None:
+    query = update.callback_query
+    user = users.get(update.effective_user.id)
+
+    if user is not None and user['available']:
+        users.update(user['id'], {'available_until': expiry.deadline()})
+        logger.info("extend_handler: %s is still looking for a partner", logger_user_data(user))
+        text = 'Отлично, продолжаю поиск! 🔎'
+    else:
+        logger.info("extend_handler: user(id=%s, nick_name=%s) isn't available anymore, but pressed the button",
+                    update.effective_user.id, update.effective_user.username)
+        metrics.mark('not_available')
+        text = 'Поиск уже остановлен. Пиши /available, когда у тебя появится минутка 😉'
+
+    query.answer()
+    outbox.submit(query.message.chat_id, query.edit_message_text, dict(text=text))
 
-    context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-    sleep(1)
-    context.bot.sendMessage(chat_id=update.effective_chat.id, text='Ты установил свой статус на 🏋️‍♂️ "недоступен".\n\nКак только у тебя снова появится минутка, пиши /available и я подберу тебе собеседника\n\nP.S. «Если сможете совершенствоваться всего на 1% каждый день в течение одного года, к концу этого периода вы станете в 37 раз лучше самого себя», – Джеймс Клир, «Атомные привычки» 😉')
+
+def report_handler(update: Update, context: CallbackContext) -> None:
+    logger.info("report_handler: admin %s called /report", logger_user_data(update.effective_user.id, update.effective_user.username))
+    replies.send(context, chat_id=update.effective_chat.id, text=render_report(user_stats.report(), English_level_names))
+
+
+def export_handler(update: Update, context: CallbackContext) -> None:
+    format = context.args[0].lower() if context.args else 'jsonl'
+    if format not in FORMATS:
+        replies.send(context, chat_id=update.effective_chat.id, text='Формат – {}'.format(' или '.join(FORMATS)))
+        metrics.mark('validation_retry')
+        return None
+
+    # Written to a file first, so that the message doesn't have to hold the whole table.
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', newline='', suffix='.' + format, delete=False) as f:
+        try:
+            exported = write_users(users.all(), f, format)
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+    logger.info("export_handler: admin %s exported %s users as %s",
+                logger_user_data(update.effective_user.id, update.effective_user.username), exported, format)
+
+    chat_id = update.effective_chat.id
+
+    def send_document():
+        with open(f.name, 'rb') as document:
+            context.bot.send_document(chat_id=chat_id, document=document, filename='users.' + format,
+                                      caption='Пользователей: {}'.format(exported))
+
+    # Removed only once the outbox is done with the upload, since it retries a failed one.
+    outbox.submit(chat_id, send_document, {}, done=lambda: os.remove(f.name))
+
+
+def import_handler(update: Update, context: CallbackContext) -> None:
+    admin = logger_user_data(update.effective_user.id, update.effective_user.username)
+    if shard is not None:
+        # A worker may only change the users it owns.
+        replies.send(context, chat_id=update.effective_chat.id,
+                     text='Импорт при нескольких процессах не работает – остановите бота и используйте admin.py import')
+        return None
+
+    document = update.message.document
+    format = format_of(document.file_name)
+    imported = 0
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'users.' + format)
+        context.bot.get_file(document.file_id).download(custom_path=path)
+        try:
+            with open(path, encoding='utf-8', newline='') as f:
+                # Through the repository, so that the caches, indexes and timers follow.
+                for doc in read_users(f, format):
+                    if doc['available'] and doc.get('available_until') is None:
+                        doc['available_until'] = expiry.deadline()
+                    if doc['id'] in users:
+                        users.update(doc['id'], doc)
+                    else:
+                        users.insert(doc)
+                    if doc['available'] and doc['level'] is not None:
+                        pool.add(doc['id'], doc['level'])
+                    else:
+                        pool.discard(doc['id'])
+                    imported += 1
+        except ValueError as e:
+            logger.info("import_handler: admin %s imported %s users before an invalid record: %s", admin, imported, e)
+            replies.send(context, chat_id=update.effective_chat.id,
+                         text='Импортировано пользователей: {}, дальше ошибка:\n{}'.format(imported, e))
+            metrics.mark('validation_retry')
+            return None
+
+    logger.info("import_handler: admin %s imported %s users", admin, imported)
+    replies.send(context, chat_id=update.effective_chat.id, text='Импортировано пользователей: {}'.format(imported))
 
 
 # TODO: restrict user in the group from typing until they register and show them help message
-def main():
-    updater = Updater(TOKEN)
+def add_handlers(dispatcher):
+    observed = bot_metrics.handler
+
+    dispatcher.add_handler(CommandHandler('available', observed(available)))
+    dispatcher.add_handler(CommandHandler('busy', observed(busy)))
+    dispatcher.add_handler(CommandHandler('list', observed(list_handler)))
+    dispatcher.add_handler(CommandHandler('stats', observed(stats_handler)))
+
+    admins = Filters.user(user_id=config.ADMIN_IDS)
+    dispatcher.add_handler(CommandHandler('report', observed(report_handler), filters=admins))
+    dispatcher.add_handler(CommandHandler('export', observed(export_handler), filters=admins))
+    dispatcher.add_handler(MessageHandler(Filters.document & Filters.caption_regex(r'^/import\b') & admins,
+                                          observed(import_handler)))
+    dispatcher.add_handler(CallbackQueryHandler(observed(list_page_handler), pattern=r'^list:'))
+    dispatcher.add_handler(CallbackQueryHandler(observed(extend_handler), pattern=r'^extend$'))
+    dispatcher.add_handler(CommandHandler('cancel', observed(cancel)))
 
-    updater.dispatcher.add_handler(CommandHandler('available', available))
-    updater.dispatcher.add_handler(CommandHandler('busy', busy))
-    updater.dispatcher.add_handler(CommandHandler('list', list_handler))
-    updater.dispatcher.add_handler(CommandHandler('cancel', cancel))
+    dispatcher.add_handler(ConversationHandler(
+        name='registration',
+        persistent=True,
 
-    updater.dispatcher.add_handler(ConversationHandler(
-        entry_points=[CommandHandler('start', start)],
+        entry_points=[CommandHandler('start', observed(start))],
 
-        fallbacks=[CommandHandler('cancel', cancel)],
+        fallbacks=[CommandHandler('cancel', observed(cancel))],
 
         states={
-            UserStates.START: [MessageHandler(Filters.text, start)],
-            UserStates.NAME: [MessageHandler(Filters.text, name_handler)],
-            UserStates.LEVEL: [MessageHandler(Filters.text, level_handler)],
-            UserStates.AGE: [MessageHandler(Filters.text, age_handler)],
-            UserStates.HOBBIES: [MessageHandler(Filters.text, hobbies_handler)]
+            UserStates.START: [MessageHandler(Filters.text, observed(start))],
+            UserStates.NAME: [MessageHandler(Filters.text, observed(name_handler))],
+            UserStates.LEVEL: [MessageHandler(Filters.text, observed(level_handler))],
+            UserStates.AGE: [MessageHandler(Filters.text, observed(age_handler))],
+            UserStates.HOBBIES: [MessageHandler(Filters.text, observed(hobbies_handler))]
         }
     ))
 
-    updater.dispatcher.add_handler(CommandHandler('start', start))
+    dispatcher.add_handler(CommandHandler('start', observed(start)))
 
-    updater.start_polling()
-    updater.idle()
+
+def serve_webhook(updater):
+    webhook = WebhookServer(updater.dispatcher)
+    bot_metrics.gauge('bot_webhook_queue_depth', 'Received updates waiting for the dispatcher.', webhook.depth)
+    webhook.run(updater)
+
+
+def main():
+    # Imported here, so that the handlers can be driven without a token (see benchmarks/load_bench.py).
+    from constants import TOKEN
+
+    updater = Updater(TOKEN, persistence=persistence)
+    add_handlers(updater.dispatcher)
+
+    if config.MATCH_MODE == 'batch':
+        updater.job_queue.run_repeating(matcher.run, interval=config.MATCH_INTERVAL)
+    if config.AVAILABILITY_TTL > 0:
+        updater.job_queue.run_repeating(expiry.run, interval=config.AVAILABILITY_TICK)
+
+    metrics_server = metrics.MetricsServer(bot_metrics.registry)
+    if config.METRICS_PORT:
+        metrics_server.start()
+
+    users.start()
+    outbox.start()
+
+    if config.UPDATES_MODE == 'webhook':
+        serve_webhook(updater)
+    else:
+        updater.start_polling()
+        updater.idle()
+
+    outbox.stop()
+    persistence.close()
+    users.close()
+    history.close()
+    metrics_server.stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,139 @@
+import logging
+import time
+from bisect import bisect_left
+
+from telegram.ext import CallbackContext
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class BatchMatcher:
+    """
+    Pairs up the whole availability pool at once, as a JobQueue job.
+
+    An exact minimum-cost matching is O(n^3), so the matching is approximated within a time
+    budget: every user only gets edges to the `candidates` users closest in age on each
+    level within the allowed distance, the edges are taken greedily by cost, and the
+    remaining time is spent on swapping partners between neighbouring pairs while that
+    lowers the total cost. Whoever is left unmatched waits for the next tick. Pairs for which
+    `excluded(user_id, partner_id)` is true, e.g. who met recently, get no edge.
+    """
+
+    def __init__(self, users, pool, notify, similarity=None, excluded=None, max_level_distance=3,
+                 candidates=config.MATCH_CANDIDATES, max_edges=config.MATCH_MAX_EDGES,
+                 time_budget=config.MATCH_TIME_BUDGET):
+        self._users = users
+        self._pool = pool
+        self._notify = notify
+        self._similarity = similarity
+        self._excluded = excluded
+        self._max_level_distance = max_level_distance
+        self._candidates = candidates
+        self._max_edges = max_edges
+        self._time_budget = time_budget
+
+    def cost(self, a, b):
+        cost = config.MATCH_LEVEL_WEIGHT * abs(a['level'] - b['level']) + config.MATCH_AGE_WEIGHT * abs(a['age'] - b['age'])
+        if self._similarity is not None:
+            cost -= config.MATCH_HOBBY_WEIGHT * self._similarity(a['id'], b['id'])
+        return cost
+
+    def _edges(self, waiting):
+        by_level = {}
+        for user in waiting:
+            by_level.setdefault(user['level'], []).append(user)
+        for bucket in by_level.values():
+            bucket.sort(key=lambda user: user['age'])
+        ages = {level: [user['age'] for user in bucket] for level, bucket in by_level.items()}
+
+        # Fewer candidates per user for huge pools, so a tick stays within MATCH_MAX_EDGES.
+        edges_per_candidate = 1 + 2 * self._max_level_distance
+        candidates = max(1, min(self._candidates, self._max_edges // max(1, len(waiting) * edges_per_candidate)))
+
+        edges = []
+        for level, bucket in by_level.items():
+            for index, user in enumerate(bucket):
+                # Users of the same age look around different positions of the other buckets.
+                offset = index - bisect_left(ages[level], user['age'])
+
+                # The next ones on the same level and the closest ones on the higher levels, so
+                # that every pair is seen once.
+                others = bucket[index + 1:index + 1 + candidates]
+                for other_level in range(level + 1, level + self._max_level_distance + 1):
+                    other_bucket = by_level.get(other_level)
+                    if other_bucket is None:
+                        continue
+                    position = min(bisect_left(ages[other_level], user['age']) + offset, len(other_bucket) - 1)
+                    others += other_bucket[max(0, position - candidates):position + candidates]
+
+                for other in others:
+                    if self._excluded is None or not self._excluded(user['id'], other['id']):
+                        edges.append((self.cost(user, other), user['id'], other['id']))
+        return edges
+
+    def match(self, waiting):
+        """Returns a list of (user, partner) pairs among the `waiting` user documents."""
+        deadline = time.monotonic() + self._time_budget
+        by_id = {user['id']: user for user in waiting}
+
+        edges = self._edges(waiting)
+        edges.sort()
+
+        matched = set()
+        pairs = []
+        for _, a, b in edges:
+            if a in matched or b in matched:
+                continue
+            matched.add(a)
+            matched.add(b)
+            pairs.append((by_id[a], by_id[b]))
+
+        # Local improvement: neighbouring pairs (by level and age) exchange partners.
+        pairs.sort(key=lambda pair: (pair[0]['level'], pair[0]['age']))
+        improved = True
+        while improved and time.monotonic() < deadline:
+            improved = False
+            for i in range(len(pairs) - 1):
+                (a, b), (c, d) = pairs[i], pairs[i + 1]
+                current = self.cost(a, b) + self.cost(c, d)
+                for first, second in (((a, c), (b, d)), ((a, d), (b, c))):
+                    if not all(self._compatible(*pair) for pair in (first, second)):
+                        continue
+                    if self.cost(*first) + self.cost(*second) < current:
+                        pairs[i], pairs[i + 1] = first, second
+                        improved = True
+                        break
+                if i % 256 == 0 and time.monotonic() >= deadline:
+                    break
+
+        return pairs
+
+    def claim(self, context, user, partner):
+        """Takes a matched pair out of the pool and lets them know."""
+        for matched in (user, partner):
+            self._users.update(matched['id'], {'available': False})
+            self._pool.discard(matched['id'])
+        self._notify(context, user, partner)
+
+    def _compatible(self, a, b):
+        if self._excluded is not None and self._excluded(a['id'], b['id']):
+            return False
+        return abs(a['level'] - b['level']) <= self._max_level_distance
+
+    def run(self, context: CallbackContext):
+        started = time.monotonic()
+        waiting = [user for user in map(self._users.get, self._pool.user_ids()) if user is not None]
+        if len(waiting) < 2:
+            return
+
+        pairs = self.match(waiting)
+        for user, partner in pairs:
+            # Someone could have gone /busy while the pairs were computed.
+            if user['id'] not in self._pool or partner['id'] not in self._pool:
+                continue
+            self.claim(context, user, partner)
+
+        logger.info("BatchMatcher: matched %s pairs out of %s waiting users in %.3fs",
+                    len(pairs), len(waiting), time.monotonic() - started)
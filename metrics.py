@@ -0,0 +1,310 @@
+import cProfile
+import functools
+import itertools
+import logging
+import pstats
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import config
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Outbox calls can wait for the flood limits and retries, so their buckets reach further.
+DELIVERY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in zip(names, values)) + '}'
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def render(self):
+        yield '# HELP {} {}'.format(self.name, self.documentation)
+        yield '# TYPE {} counter'.format(self.name)
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield '{}{} {}'.format(self.name, _labels(self.labelnames, labels), value)
+
+
+class Gauge:
+    """A value read from `function()` when the metrics are scraped."""
+
+    def __init__(self, name, documentation, function):
+        self.name = name
+        self.documentation = documentation
+        self._function = function
+
+    def render(self):
+        yield '# HELP {} {}'.format(self.name, self.documentation)
+        yield '# TYPE {} gauge'.format(self.name)
+        yield '{} {}'.format(self.name, self._function())
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._buckets = tuple(buckets)
+        self._series = {}  # labels -> [per-bucket counts (the last one is +Inf), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect_left(self._buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self._buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def count(self, *labels):
+        series = self._series.get(labels)
+        return sum(series[0]) if series else 0
+
+    def total(self, *labels):
+        series = self._series.get(labels)
+        return series[1] if series else 0.0
+
+    def render(self):
+        yield '# HELP {} {}'.format(self.name, self.documentation)
+        yield '# TYPE {} histogram'.format(self.name)
+        with self._lock:
+            series = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._series.items())
+        names = self.labelnames + ('le',)
+        for labels, (counts, total) in series:
+            cumulative = 0
+            for bound, count in zip(self._buckets + ('+Inf',), counts):
+                cumulative += count
+                yield '{}_bucket{} {}'.format(self.name, _labels(names, labels + (bound,)), cumulative)
+            yield '{}_sum{} {}'.format(self.name, _labels(self.labelnames, labels), total)
+            yield '{}_count{} {}'.format(self.name, _labels(self.labelnames, labels), cumulative)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """The metrics in the Prometheus text exposition format."""
+        return '\n'.join(line for metric in self._metrics for line in metric.render()) + '\n'
+
+
+# The outcome of the handler running on this thread, see mark().
+_outcome = threading.local()
+
+
+def mark(outcome):
+    """Records how the current handler ended, e.g. 'validation_retry' or 'not_registered'."""
+    _outcome.value = outcome
+
+
+class Profiler:
+    """
+    Runs every `rate`-th call under cProfile and accumulates the results in `path`, which
+    can be read with `python -m pstats`. A rate of 0 turns profiling off.
+    """
+
+    def __init__(self, rate=config.PROFILE_SAMPLE_RATE, path=config.PROFILE_PATH):
+        self._rate = rate
+        self._path = path
+        self._counter = itertools.count(1)
+        self._stats = None
+        self._lock = threading.Lock()
+
+    def call(self, function, *args, **kwargs):
+        if not self._rate or next(self._counter) % self._rate:
+            return function(*args, **kwargs)
+
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(function, *args, **kwargs)
+        finally:
+            with self._lock:
+                if self._stats is None:
+                    self._stats = pstats.Stats(profile)
+                else:
+                    self._stats.add(profile)
+                self._stats.dump_stats(self._path)
+
+
+class TimedStorage(Storage):
+    """Wraps a Storage to count and time its operations."""
+
+    def __init__(self, storage, latency, errors, rows_written):
+        self._storage = storage
+        self._latency = latency
+        self._errors = errors
+        self._rows_written = rows_written
+
+    def _timed(self, operation, *args):
+        started = time.perf_counter()
+        try:
+            return getattr(self._storage, operation)(*args)
+        except Exception:
+            self._errors.inc(operation)
+            raise
+        finally:
+            self._latency.observe(time.perf_counter() - started, operation)
+
+    def insert(self, doc):
+        self._rows_written.inc('insert')
+        return self._timed('insert', doc)
+
+    def get(self, user_id):
+        return self._timed('get', user_id)
+
+    def update(self, user_id, fields):
+        self._rows_written.inc('update')
+        return self._timed('update', user_id, fields)
+
+    def remove(self, user_id):
+        self._rows_written.inc('remove')
+        return self._timed('remove', user_id)
+
+    def all(self):
+        # all() may stream, so the time it takes to go through the whole table is measured.
+        started = time.perf_counter()
+        try:
+            yield from self._storage.all()
+        except Exception:
+            self._errors.inc('all')
+            raise
+        finally:
+            self._latency.observe(time.perf_counter() - started, 'all')
+
+    def available_by_level(self, min_level, max_level):
+        return self._timed('available_by_level', min_level, max_level)
+
+    def write_batch(self, upserts, removals):
+        self._rows_written.inc('write_batch', amount=len(upserts) + len(removals))
+        return self._timed('write_batch', upserts, removals)
+
+    def close(self):
+        return self._timed('close')
+
+
+class BotMetrics:
+    """The bot's handler, storage and Bot API metrics."""
+
+    def __init__(self, registry=None, profiler=None):
+        self.registry = registry or Registry()
+        self.profiler = profiler or Profiler()
+
+        self.handler_latency = self.registry.register(Histogram(
+            'bot_handler_latency_seconds', 'Time spent in update handlers.', ('handler',)))
+        self.handler_calls = self.registry.register(Counter(
+            'bot_handler_calls_total', 'Handler calls by outcome.', ('handler', 'outcome')))
+        self.storage_latency = self.registry.register(Histogram(
+            'bot_storage_operation_seconds', 'Time spent in storage operations.', ('operation',)))
+        self.storage_errors = self.registry.register(Counter(
+            'bot_storage_errors_total', 'Failed storage operations.', ('operation',)))
+        self.storage_rows_written = self.registry.register(Counter(
+            'bot_storage_rows_written_total', 'Rows inserted, updated or removed by storage operations.', ('operation',)))
+        self.api_latency = self.registry.register(Histogram(
+            'bot_api_call_seconds', 'Time spent in outbound Bot API calls.', ('method', 'outcome')))
+        self.outbox_latency = self.registry.register(Histogram(
+            'bot_outbox_delivery_seconds', 'Time from submitting a Bot API call to the outbox until it went out.',
+            ('priority',), buckets=DELIVERY_BUCKETS))
+        self.outbox_calls = self.registry.register(Counter(
+            'bot_outbox_calls_total', 'Outbox calls that went out or failed for good.', ('priority', 'outcome')))
+
+    def gauge(self, name, documentation, function):
+        self.registry.register(Gauge(name, documentation, function))
+
+    def handler(self, callback):
+        """Wraps an update handler callback to time it and count its outcomes."""
+        name = callback.__name__
+
+        @functools.wraps(callback)
+        def wrapper(update, context):
+            _outcome.value = None
+            started = time.perf_counter()
+            outcome = 'error'
+            try:
+                result = self.profiler.call(callback, update, context)
+                outcome = _outcome.value or 'success'
+                return result
+            finally:
+                self.handler_latency.observe(time.perf_counter() - started, name)
+                self.handler_calls.inc(name, outcome)
+
+        return wrapper
+
+    def storage(self, storage):
+        return TimedStorage(storage, self.storage_latency, self.storage_errors, self.storage_rows_written)
+
+    def api_call(self, send, seconds, outcome):
+        """Outbox callback for every Bot API call it made."""
+        self.api_latency.observe(seconds, getattr(send, '__name__', 'call'), outcome)
+
+    def outbox_delivered(self, priority, seconds, outcome):
+        """Outbox callback for every call it's done with."""
+        if outcome == 'sent':
+            self.outbox_latency.observe(seconds, priority)
+        self.outbox_calls.inc(priority, outcome)
+
+
+class MetricsServer:
+    """Serves the registry at /metrics from a daemon thread."""
+
+    def __init__(self, registry, host=config.METRICS_HOST, port=config.METRICS_PORT):
+        self._registry = registry
+        self._address = (host, port)
+        self._server = None
+
+    def start(self):
+        registry = self._registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug("MetricsServer: " + format, *args)
+
+        self._server = ThreadingHTTPServer(self._address, Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='MetricsServer', daemon=True).start()
+        logger.info("MetricsServer: serving metrics at http://%s:%s/metrics", *self._server.server_address[:2])
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
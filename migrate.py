@@ -0,0 +1,28 @@
+import argparse
+import time
+
+import config
+from storage import SQLiteStorage, import_tinydb
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Copies the users from a TinyDB JSON file into SQLite.')
+    parser.add_argument('source', nargs='?', default=config.DB_PATH, help='TinyDB JSON file (default: %(default)s)')
+    parser.add_argument('target', nargs='?', default=config.SQLITE_PATH, help='SQLite database (default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=1000, help='users per transaction (default: %(default)s)')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    storage = SQLiteStorage(args.target)
+    try:
+        imported = import_tinydb(args.source, storage, batch_size=args.batch_size)
+    finally:
+        storage.close()
+
+    print("Imported {} users from {} into {} in {:.2f}s".format(imported, args.source, args.target,
+                                                               time.perf_counter() - started))
+    print("Set BOT_STORAGE_BACKEND=sqlite to use it.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from enum import IntEnum
+
+from telegram.error import RetryAfter, NetworkError, BadRequest
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    MATCH = 0
+    REPLY = 1
+    CHAT_ACTION = 2
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Seconds until a token is available."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Item:
+    __slots__ = ('chat_id', 'send', 'kwargs', 'priority', 'done', 'submitted', 'attempts')
+
+    def __init__(self, chat_id, send, kwargs, priority, done):
+        self.chat_id = chat_id
+        self.send = send
+        self.kwargs = kwargs
+        self.priority = priority
+        self.done = done
+        self.submitted = time.monotonic()
+        self.attempts = 0
+
+
+class Outbox:
+    """
+    Delivers outbound Bot API calls from a few worker threads within Telegram's flood limits.
+
+    Calls wait for a token of the global bucket and of their chat's bucket and go out by
+    priority (match notifications before replies before chat actions), in submission order
+    within a priority. A chat is owned by at most one call at a time - the one being sent,
+    waiting for a token or waiting to be retried - and the chat's other calls are parked
+    behind it, so the order within a chat holds across rate limiting and retries. A 429
+    pauses all deliveries for its `retry_after`.
+
+    `on_call(send, seconds, outcome)`, if given, is called after every attempt with its
+    duration and 'ok', 'flood_limited', 'retried' or 'failed'. `on_delivered(priority,
+    seconds, outcome)`, if given, is called once per call when it went out ('sent') or
+    failed for good ('failed'), with the priority's name and the seconds since it was submitted.
+    """
+
+    def __init__(self, workers=config.OUTBOX_WORKERS,
+                 global_rate=config.OUTBOX_GLOBAL_RATE, global_burst=config.OUTBOX_GLOBAL_BURST,
+                 chat_rate=config.OUTBOX_CHAT_RATE, chat_burst=config.OUTBOX_CHAT_BURST,
+                 max_retries=config.OUTBOX_MAX_RETRIES, on_call=None, on_delivered=None):
+        self._workers_count = workers
+        self._on_call = on_call
+        self._on_delivered = on_delivered
+        self._global_bucket = TokenBucket(global_rate, global_burst)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._max_retries = max_retries
+
+        self._condition = threading.Condition()
+        self._sequence = itertools.count()
+        self._ready = []  # (priority, sequence, item)
+        self._delayed = []  # (not before, priority, sequence, item)
+        self._owners = {}  # chat id -> the item that owns the chat
+        self._parked = {}  # chat id -> deque of (priority, sequence, item)
+        self._chat_buckets = {}
+        self._paused_until = 0.0
+        self._workers = []
+        self._running = False
+
+    def depth(self):
+        with self._condition:
+            return len(self._ready) + len(self._delayed) + sum(len(parked) for parked in self._parked.values())
+
+    def submit(self, chat_id, send, kwargs, priority=Priority.REPLY, done=None):
+        """
+        Queues `send(**kwargs)`, a Bot API call to `chat_id`. `done()`, if given, is called
+        once the call went out or failed for good, i.e. it won't be retried any more.
+        """
+        item = _Item(chat_id, send, kwargs, priority, done)
+        with self._condition:
+            heapq.heappush(self._ready, (priority, next(self._sequence), item))
+            self._condition.notify()
+
+    def _next(self):
+        # Called with the condition held; blocks until an item may be sent or the outbox stops.
+        while self._running:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, priority, sequence, item = heapq.heappop(self._delayed)
+                heapq.heappush(self._ready, (priority, sequence, item))
+
+            if not self._ready:
+                self._condition.wait(self._delayed[0][0] - now if self._delayed else None)
+                continue
+
+            priority, sequence, item = heapq.heappop(self._ready)
+            owner = self._owners.get(item.chat_id)
+            if owner is not None and owner is not item:
+                self._parked.setdefault(item.chat_id, deque()).append((priority, sequence, item))
+                continue
+            self._owners[item.chat_id] = item
+
+            chat_bucket = self._chat_buckets.get(item.chat_id)
+            if chat_bucket is None:
+                chat_bucket = self._chat_buckets[item.chat_id] = TokenBucket(self._chat_rate, self._chat_burst)
+            wait = max(self._paused_until - now, self._global_bucket.delay(now), chat_bucket.delay(now))
+            if wait > 0:
+                heapq.heappush(self._delayed, (now + wait, priority, sequence, item))
+                continue
+
+            self._global_bucket.take(now)
+            chat_bucket.take(now)
+            return priority, sequence, item
+        return None
+
+    def _release(self, item):
+        # Called with the condition held.
+        del self._owners[item.chat_id]
+        parked = self._parked.pop(item.chat_id, None)
+        if parked:
+            for entry in parked:
+                heapq.heappush(self._ready, entry)
+            self._condition.notify_all()
+
+        if len(self._chat_buckets) > 10000:
+            now = time.monotonic()
+            for chat_id in [chat_id for chat_id, bucket in self._chat_buckets.items()
+                            if chat_id not in self._owners and bucket.full(now)]:
+                del self._chat_buckets[chat_id]
+
+    def _retry(self, entry, delay):
+        # Called with the condition held; the item keeps owning its chat.
+        priority, sequence, item = entry
+        heapq.heappush(self._delayed, (time.monotonic() + delay, priority, sequence, item))
+        self._condition.notify()
+
+    def _deliver(self, entry):
+        item = entry[2]
+        item.attempts += 1
+        started = time.monotonic()
+        try:
+            item.send(**item.kwargs)
+        except RetryAfter as e:
+            self._called(item, started, 'flood_limited')
+            logger.warning("Outbox: flood limit hit, pausing deliveries for %ss", e.retry_after)
+            with self._condition:
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                self._retry(entry, e.retry_after)
+            return
+        except NetworkError as e:
+            # Timeouts and connection errors are worth retrying, invalid requests are not.
+            if item.attempts <= self._max_retries and not isinstance(e, BadRequest):
+                self._called(item, started, 'retried')
+                logger.warning("Outbox: delivery to chat %s failed (%s), retrying", item.chat_id, e)
+                with self._condition:
+                    self._retry(entry, 2 ** item.attempts)
+                return
+            logger.error("Outbox: couldn't deliver to chat %s: %s", item.chat_id, e)
+            failed = True
+        except Exception:
+            logger.exception("Outbox: couldn't deliver to chat %s", item.chat_id)
+            failed = True
+        else:
+            failed = False
+        try:
+            self._called(item, started, 'failed' if failed else 'ok')
+            if self._on_delivered is not None:
+                self._on_delivered(Priority(item.priority).name.lower(), time.monotonic() - item.submitted,
+                                   'failed' if failed else 'sent')
+            with self._condition:
+                self._release(item)
+        finally:
+            if item.done is not None:
+                item.done()
+
+    def _called(self, item, started, outcome):
+        if self._on_call is not None:
+            self._on_call(item.send, time.monotonic() - started, outcome)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                entry = self._next()
+            if entry is None:
+                return
+            self._deliver(entry)
+
+    def start(self):
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+        for i in range(self._workers_count):
+            worker = threading.Thread(target=self._run, name='Outbox-worker-{}'.format(i), daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self, timeout=10.0):
+        """Waits up to `timeout` seconds for the queued calls to go out and stops the workers."""
+        deadline = time.monotonic() + timeout
+        while self.depth() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
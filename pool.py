@@ -0,0 +1,109 @@
+import random
+import threading
+
+
+class AvailabilityPool:
+    """
+    Available users bucketed by their English level index.
+
+    Every bucket is a list plus a position map, so adding, removing and drawing a random
+    member are O(1) (removal swaps the last element into the freed slot).
+    """
+
+    def __init__(self, levels_count, spread=3):
+        self._spread = spread
+        self._buckets = [[] for _ in range(levels_count)]
+        self._positions = {}  # user id -> (level, index in the bucket)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __contains__(self, user_id):
+        return user_id in self._positions
+
+    def add(self, user_id, level):
+        with self._lock:
+            if user_id in self._positions:
+                self._discard(user_id)
+            bucket = self._buckets[level]
+            self._positions[user_id] = (level, len(bucket))
+            bucket.append(user_id)
+
+    def discard(self, user_id):
+        with self._lock:
+            self._discard(user_id)
+
+    def _discard(self, user_id):
+        position = self._positions.pop(user_id, None)
+        if position is None:
+            return
+        level, index = position
+        bucket = self._buckets[level]
+        last = bucket.pop()
+        if index < len(bucket):
+            bucket[index] = last
+            self._positions[last] = (level, index)
+
+    def user_ids(self):
+        with self._lock:
+            return list(self._positions)
+
+    def within(self, user_id, level):
+        """Whether `user_id` is in the pool within the level range of `level`."""
+        position = self._positions.get(user_id)
+        if position is None:
+            return False
+        low, high = self.level_range(level)
+        return low <= position[0] <= high
+
+    def level_range(self, level):
+        return max(0, level - self._spread), min(len(self._buckets) - 1, level + self._spread)
+
+    def members(self, level):
+        low, high = self.level_range(level)
+        with self._lock:
+            return [user_id for bucket in self._buckets[low:high + 1] for user_id in bucket]
+
+    def choice(self, level, exclude=None, allowed=None, attempts=8):
+        """
+        Returns a uniformly random user id within the level range of `level`, or None.
+        With `allowed`, up to `attempts` draws are made until one passes it; if none does, the
+        rest of the range is scanned, so None means that no one there is allowed.
+        """
+        low, high = self.level_range(level)
+        with self._lock:
+            # The excluded user is treated as if it were swapped to the end of its bucket.
+            excluded_level, excluded_index = self._positions.get(exclude, (None, None))
+            sizes = [len(self._buckets[lvl]) - (lvl == excluded_level) for lvl in range(low, high + 1)]
+            total = sum(sizes)
+            if total <= 0:
+                return None
+
+            for _ in range(attempts if allowed is not None else 1):
+                user_id = self._draw(random.randrange(total), low, high, sizes, excluded_level, excluded_index)
+                if allowed is None or allowed(user_id):
+                    return user_id
+            if allowed is None:
+                return None
+
+            candidates = [user_id for bucket in self._buckets[low:high + 1] for user_id in bucket
+                          if user_id != exclude and allowed(user_id)]
+            return random.choice(candidates) if candidates else None
+
+    def _draw(self, index, low, high, sizes, excluded_level, excluded_index):
+        for lvl, size in zip(range(low, high + 1), sizes):
+            if index < size:
+                bucket = self._buckets[lvl]
+                if lvl == excluded_level and index == excluded_index:
+                    return bucket[-1]
+                return bucket[index]
+            index -= size
+
+    def rebuild(self, users):
+        with self._lock:
+            self._buckets = [[] for _ in self._buckets]
+            self._positions = {}
+        for user in users:
+            if user['available'] and user['level'] is not None:
+                self.add(user['id'], user['level'])
@@ -0,0 +1,103 @@
+import threading
+from collections import Counter
+
+# The registration questions in the order they're asked, as in main.UserStates.
+STEPS = ('name', 'level', 'age', 'hobbies')
+
+
+def step_of(user):
+    """The first unanswered registration question of `user`, None for a complete profile."""
+    for field in STEPS:
+        if user[field] is None:
+            return field
+    return None
+
+
+class UserStats:
+    """
+    Aggregates over the user table: users per level, an age histogram, how many are
+    available and where the registration stops.
+
+    They're counters that add() and discard() change by one profile, so a UserRepository
+    listener (track) keeps them current at O(1) per change and a report never scans the users.
+    The same class computes a report offline in one streaming pass (see admin.py).
+    """
+
+    def __init__(self, age_bucket=10):
+        self._age_bucket = age_bucket
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._users = 0
+        self._complete = 0
+        self._available = 0
+        self._levels = Counter()
+        self._ages = Counter()
+        self._steps = Counter()  # the unanswered question of the incomplete profiles
+
+    def _count(self, user, sign):
+        step = step_of(user)
+        self._users += sign
+        if step is not None:
+            self._steps[step] += sign
+            return
+        self._complete += sign
+        self._available += sign * bool(user['available'])
+        self._levels[user['level']] += sign
+        self._ages[user['age'] // self._age_bucket * self._age_bucket] += sign
+
+    def add(self, user):
+        with self._lock:
+            self._count(user, 1)
+
+    def discard(self, user):
+        with self._lock:
+            self._count(user, -1)
+
+    def track(self, old, new):
+        """UserRepository listener."""
+        with self._lock:
+            if old is not None:
+                self._count(old, -1)
+            if new is not None:
+                self._count(new, 1)
+
+    def rebuild(self, users):
+        with self._lock:
+            self._reset()
+        for user in users:
+            self.add(user)
+
+    def report(self):
+        with self._lock:
+            # A user reached a step if they answered it or stopped there.
+            reached = self._users
+            funnel = []
+            for step in STEPS:
+                stopped = self._steps[step]
+                funnel.append({'step': step, 'reached': reached, 'stopped': stopped,
+                               'drop_off': stopped / reached if reached else 0.0})
+                reached -= stopped
+
+            return {
+                'users': self._users,
+                'complete': self._complete,
+                'available': self._available,
+                'available_ratio': self._available / self._complete if self._complete else 0.0,
+                'levels': {level: count for level, count in sorted(self._levels.items()) if count},
+                'ages': {'{}-{}'.format(age, age + self._age_bucket - 1): count
+                         for age, count in sorted(self._ages.items()) if count},
+                'funnel': funnel,
+            }
+
+
+def render_report(report, level_names):
+    lines = ['Users: {users}, registered: {complete}, available: {available} ({available_ratio:.0%})'.format(**report),
+             '', 'Levels:']
+    lines += ['  {}: {}'.format(level_names[level], count) for level, count in report['levels'].items()]
+    lines += ['', 'Ages:']
+    lines += ['  {}: {}'.format(ages, count) for ages, count in report['ages'].items()]
+    lines += ['', 'Registration (reached / stopped there):']
+    lines += ['  {step}: {reached} / {stopped} ({drop_off:.0%})'.format(**step) for step in report['funnel']]
+    return '\n'.join(lines)
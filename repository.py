@@ -0,0 +1,174 @@
+import logging
+import threading
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class UserRepository:
+    """
+    In-memory index of the user table in front of a storage backend (see storage.py).
+
+    Lookups by user id and chat id are O(1) dict hits. Changes are written behind: they are
+    coalesced in memory and persisted by a background thread in a single batch per flush.
+    Returned documents are shared with the index, so treat them as read-only and change
+    them through update().
+    """
+
+    def __init__(self, storage, flush_interval=config.FLUSH_INTERVAL, max_pending=config.FLUSH_MAX_PENDING):
+        self._storage = storage
+        self._flush_interval = flush_interval
+        self._max_pending = max_pending
+
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        self._by_id = {}
+        self._by_chat = {}
+        self._dirty = set()
+        self._removed = set()
+        self._listeners = []
+
+        for doc in storage.all():
+            self._index(doc)
+
+        logger.info("UserRepository: loaded %s users", len(self._by_id))
+
+    def _index(self, doc):
+        self._by_id[doc['id']] = doc
+        self._by_chat[doc['chat_id']] = doc
+
+    def add_listener(self, listener):
+        """`listener(old, new)` is called after every change, with None for a missing side."""
+        self._listeners.append(listener)
+
+    def _notify(self, old, new):
+        for listener in self._listeners:
+            listener(old, new)
+
+    def _changed(self, user_id, removed=False):
+        if removed:
+            self._dirty.discard(user_id)
+            self._removed.add(user_id)
+        else:
+            self._removed.discard(user_id)
+            self._dirty.add(user_id)
+        if len(self._dirty) + len(self._removed) >= self._max_pending:
+            self._wake.set()
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __contains__(self, user_id):
+        return user_id in self._by_id
+
+    def get(self, user_id):
+        return self._by_id.get(user_id)
+
+    def get_by_chat(self, chat_id):
+        return self._by_chat.get(chat_id)
+
+    def all(self):
+        with self._lock:
+            return list(self._by_id.values())
+
+    def insert(self, doc):
+        with self._lock:
+            doc = dict(doc)
+            self._index(doc)
+            self._changed(doc['id'])
+            self._notify(None, doc)
+            return doc
+
+    def update(self, user_id, fields):
+        with self._lock:
+            doc = self._by_id.get(user_id)
+            if doc is None:
+                return None
+            old = dict(doc)
+            if 'chat_id' in fields and fields['chat_id'] != doc['chat_id']:
+                self._by_chat.pop(doc['chat_id'], None)
+                self._by_chat[fields['chat_id']] = doc
+            doc.update(fields)
+            self._changed(user_id)
+            self._notify(old, doc)
+            return doc
+
+    def remove(self, user_id):
+        with self._lock:
+            doc = self._by_id.pop(user_id, None)
+            if doc is None:
+                return None
+            if self._by_chat.get(doc['chat_id']) is doc:
+                del self._by_chat[doc['chat_id']]
+            self._changed(user_id, removed=True)
+            self._notify(doc, None)
+            return doc
+
+    def replicate(self, user_id, doc):
+        """
+        Applies a change of a user this repository doesn't own (see sharding.py): the listeners
+        learn about it, but it's not written to the storage. `doc` is None for a removal.
+        """
+        with self._lock:
+            old = self._by_id.pop(user_id, None)
+            if old is not None and self._by_chat.get(old['chat_id']) is old:
+                del self._by_chat[old['chat_id']]
+            if doc is not None:
+                doc = dict(doc)
+                self._index(doc)
+            if old is not None or doc is not None:
+                self._notify(old, doc)
+
+    def flush(self):
+        # _flush_lock keeps batches from being written out of order.
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty and not self._removed:
+                    return
+                upserts = [dict(self._by_id[user_id]) for user_id in self._dirty]
+                removals = list(self._removed)
+                self._dirty = set()
+                self._removed = set()
+
+            try:
+                self._storage.write_batch(upserts, removals)
+            except Exception:
+                with self._lock:
+                    # Whatever changed since the snapshot is already tracked and wins.
+                    for doc in upserts:
+                        if doc['id'] in self._by_id and doc['id'] not in self._removed:
+                            self._dirty.add(doc['id'])
+                    for user_id in removals:
+                        if user_id not in self._by_id:
+                            self._removed.add(user_id)
+                raise
+
+            logger.debug("UserRepository: flushed %s upserts and %s removals", len(upserts), len(removals))
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self._flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("UserRepository: flush failed, will retry")
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='UserRepository-flusher', daemon=True)
+            self._thread.start()
+
+    def close(self):
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        self._storage.close()
@@ -0,0 +1,375 @@
+"""
+Runs the bot as a front process and SHARDS worker processes:
+
+    BOT_SHARDS=4 BOT_STORAGE_BACKEND=sqlite python sharding.py
+
+The front receives the updates (polling or webhook, as main.py) and hands every update to
+the worker that owns its user, shard_of(user id), so each user's conversation is handled in
+order by one worker. A worker owns the profiles of its users: only it changes them and
+writes them to the shared SQLite database, so the workers never write the same rows.
+
+Every change of an owned profile is published through the front to the other workers, which
+keep read-only replicas of the other shards' users. The availability pool, the hobby index
+and /list therefore work locally in every worker and see the others' changes within
+milliseconds. Whatever has to change a user of another shard is sent as an event to its
+owner instead:
+
+- a match notification goes to the partner's worker, so every chat is written to by one
+  worker only;
+- in batch mode the front matches the whole pool on its own replica and claims each pair
+  from the owners: the user's worker takes the user out of the pool and asks the partner's
+  worker to do the same, which either confirms the match (and both get notified) or has
+  the user's worker put the user back. A user's own update in between cancels the claim.
+"""
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from queue import Queue
+
+from telegram import Bot, Update
+from telegram.ext import CallbackContext, Dispatcher, JobQueue, TypeHandler, Updater
+
+import config
+from matchmaking import BatchMatcher
+from webhook import WebhookServer
+
+logger = logging.getLogger(__name__)
+
+
+def shard_of(user_id, shards):
+    return user_id % shards
+
+
+class Shard:
+    """A worker's view of the sharding: the users it owns and the way to reach the others."""
+
+    def __init__(self, index, count, outbound):
+        self.index = index
+        self.count = count
+        self._outbound = outbound
+
+    def owns(self, user_id):
+        return shard_of(user_id, self.count) == self.index
+
+    def send(self, user_id, kind, *args):
+        """Sends an event to the worker that owns `user_id`."""
+        self._outbound.put(('event', user_id, kind, args))
+
+    def publish(self, old, new):
+        """UserRepository listener: replicates the changes of the owned users to the other workers."""
+        user_id = (new or old)['id']
+        if self.owns(user_id):
+            self._outbound.put(('replicate', self.index, user_id, dict(new) if new is not None else None))
+
+
+def _sync_pool(pool, user_id, doc):
+    if doc is not None and doc['available'] and doc['level'] is not None:
+        pool.add(user_id, doc['level'])
+    else:
+        pool.discard(user_id)
+
+
+def _configure_worker(index, count):
+    # The modules imported by main bind these as defaults, so they are changed before main is imported.
+    config.CONVERSATIONS_PATH = '{}.{}'.format(config.CONVERSATIONS_PATH, index)
+    root, extension = os.path.splitext(config.HISTORY_PATH)
+    config.HISTORY_PATH = '{}.{}{}'.format(root, index, extension)
+    root, extension = os.path.splitext(config.LOG_PATH)
+    config.LOG_PATH = '{}.{}{}'.format(root, index, extension)
+    config.OUTBOX_GLOBAL_RATE /= count
+    config.OUTBOX_GLOBAL_BURST = max(1, config.OUTBOX_GLOBAL_BURST // count)
+    config.METRICS_PORT = config.METRICS_PORT + 1 + index if config.METRICS_PORT else 0
+
+
+# The commands that change the availability of whoever sends them.
+_AVAILABILITY_COMMANDS = ('/available', '/busy', '/cancel')
+
+
+class _Worker:
+    def __init__(self, main, shard, context):
+        self._main = main
+        self._shard = shard
+        self._context = context
+        self._claims = {}  # user id -> the partner id of a pending batch match claim
+
+    def _hold(self, user_id):
+        users = self._main.users
+        user = users.get(user_id)
+        if user is None or not user['available']:
+            return None
+        users.update(user_id, {'available': False})
+        self._main.pool.discard(user_id)
+        return user
+
+    def touched(self, user_id, data):
+        # The user changed their availability themselves, so a claim of theirs must not be undone.
+        words = ((data.get('message') or {}).get('text') or '').split()
+        if words and words[0].split('@')[0] in _AVAILABILITY_COMMANDS:
+            self._claims.pop(user_id, None)
+
+    def refresh(self, user_id):
+        user = self._main.users.get(user_id)
+        if user is not None:
+            self._shard.publish(user, user)
+
+    def replicate(self, user_id, doc):
+        self._main.users.replicate(user_id, doc)
+        _sync_pool(self._main.pool, user_id, doc)
+
+    def event(self, kind, args):
+        main, users = self._main, self._main.users
+        if kind == 'notify':
+            user_id, partner_id = args
+            user, partner = users.get(user_id), users.get(partner_id)
+            if user is not None and partner is not None:
+                main.send_match(self._context, user, partner)
+
+        elif kind == 'claim':
+            user_id, partner_id = args
+            if main.history.met(user_id, partner_id):
+                # The front took both out of its pool: the owners' current state puts them back.
+                self.refresh(user_id)
+                self._shard.send(partner_id, 'refresh', partner_id)
+            elif self._hold(user_id) is not None:
+                self._claims[user_id] = partner_id
+                self._shard.send(partner_id, 'confirm', partner_id, user_id)
+            else:
+                # The user left the pool themselves, which the front learns from them; the partner didn't.
+                self._shard.send(partner_id, 'refresh', partner_id)
+
+        elif kind == 'confirm':
+            partner_id, user_id = args
+            partner = self._hold(partner_id)
+            if partner is None:
+                self._shard.send(user_id, 'release', user_id)
+                return
+            user = users.get(user_id)
+            if user is None:
+                # The user deleted their profile meanwhile.
+                users.update(partner_id, {'available': True})
+                main.pool.add(partner_id, partner['level'])
+                return
+            main.send_match(self._context, partner, user)
+            self._shard.send(user_id, 'matched', user_id, partner_id)
+
+        elif kind == 'matched':
+            user_id, partner_id = args
+            self._claims.pop(user_id, None)
+            user, partner = users.get(user_id), users.get(partner_id)
+            if user is not None and partner is not None:
+                main.send_match(self._context, user, partner)
+            logger.info("Shard %s: users %s and %s were matched", self._shard.index, user_id, partner_id)
+
+        elif kind == 'refresh':
+            self.refresh(*args)
+
+        elif kind == 'release':
+            user_id, = args
+            user = users.get(user_id)
+            if self._claims.pop(user_id, None) is not None and user is not None:
+                users.update(user_id, {'available': True})
+                main.pool.add(user_id, user['level'])
+
+
+def run_worker(index, count, inbound, outbound, make_bot=None, measure=False):
+    """The main function of a worker process. With `measure` the update latencies are kept for barrier()."""
+    # A Ctrl-C or SIGTERM reaches the whole process group: the front's None stops the worker
+    # after the updates sent before it, with the profiles and conversations flushed.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    _configure_worker(index, count)
+
+    import main
+    import metrics
+
+    main.shard = shard = Shard(index, count, outbound)
+    if make_bot is not None:
+        bot = make_bot()
+    else:
+        from constants import TOKEN
+        bot = Bot(TOKEN)
+
+    job_queue = JobQueue()
+    dispatcher = Dispatcher(bot, Queue(), job_queue=job_queue, persistence=main.persistence)
+    job_queue.set_dispatcher(dispatcher)
+    main.add_handlers(dispatcher)
+    main.users.add_listener(shard.publish)
+    if config.AVAILABILITY_TTL > 0:
+        job_queue.run_repeating(main.expiry.run, interval=config.AVAILABILITY_TICK)
+    worker = _Worker(main, shard, CallbackContext(dispatcher))
+
+    metrics_server = metrics.MetricsServer(main.bot_metrics.registry, port=config.METRICS_PORT)
+    if config.METRICS_PORT:
+        metrics_server.start()
+    job_queue.start()
+    main.users.start()
+    main.outbox.start()
+    outbound.put(('ready', index))
+
+    latencies = []
+    while True:
+        message = inbound.get()
+        if message is None:
+            break
+        kind = message[0]
+        if kind == 'update':
+            _, user_id, data = message
+            worker.touched(user_id, data)
+            started = time.perf_counter()
+            dispatcher.process_update(Update.de_json(data, bot))
+            if measure:
+                latencies.append(time.perf_counter() - started)
+        elif kind == 'replicate':
+            worker.replicate(*message[1:])
+        elif kind == 'event':
+            worker.event(*message[1:])
+        elif kind == 'barrier':
+            outbound.put(('barrier', index, latencies))
+            latencies = []
+
+    main.outbox.stop()
+    main.persistence.close()
+    main.users.close()
+    main.history.close()
+    job_queue.stop()
+    metrics_server.stop()
+
+
+class ShardedBatchMatcher(BatchMatcher):
+    """Matches the front's replica of the pool and claims the pairs from the workers that own them."""
+
+    def __init__(self, coordinator, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._coordinator = coordinator
+
+    def claim(self, context, user, partner):
+        # Out of the replica until the owners' changes come back, so the next tick doesn't pick them again.
+        self._pool.discard(user['id'])
+        self._pool.discard(partner['id'])
+        self._coordinator.event(user['id'], 'claim', (user['id'], partner['id']))
+
+
+class Coordinator:
+    """
+    The front process's side: routes updates and events to the workers and relays the
+    replication between them. `users` and `pool` are the front's own replicas, used for
+    batch matching, and `history` records the batch matches it relays.
+    """
+
+    def __init__(self, count, users, pool, make_bot=None, history=None, measure=False):
+        if count > 1 and config.STORAGE_BACKEND != 'sqlite':
+            raise ValueError("Sharding needs the sqlite storage backend, as the workers share the database")
+        self.count = count
+        self._users = users
+        self._pool = pool
+        self._history = history
+        # spawn, so that every worker imports main itself, with its own configuration.
+        context = multiprocessing.get_context('spawn')
+        self._inbound = [context.Queue() for _ in range(count)]
+        self._outbound = context.Queue()
+        self._processes = [context.Process(target=run_worker, name='shard-{}'.format(index),
+                                           args=(index, count, self._inbound[index], self._outbound, make_bot, measure))
+                           for index in range(count)]
+        self._barriers = []
+        self._barrier_condition = threading.Condition()
+        self._relay = threading.Thread(target=self._run_relay, name='Coordinator-relay', daemon=True)
+
+    def submit(self, user_id, data):
+        """Hands a raw update of `user_id` (None if it has no user) to its worker."""
+        index = shard_of(user_id, self.count) if user_id is not None else 0
+        self._inbound[index].put(('update', user_id, data))
+
+    def route(self, update: Update, context):
+        """Front dispatcher handler that sends every update to its worker."""
+        user = update.effective_user
+        self.submit(user.id if user is not None else None, update.to_dict())
+
+    def event(self, user_id, kind, args):
+        self._inbound[shard_of(user_id, self.count)].put(('event', kind, args))
+
+    def _run_relay(self):
+        while True:
+            message = self._outbound.get()
+            if message is None:
+                return
+            kind = message[0]
+            if kind == 'replicate':
+                _, origin, user_id, doc = message
+                self._users.replicate(user_id, doc)
+                _sync_pool(self._pool, user_id, doc)
+                for index, inbound in enumerate(self._inbound):
+                    if index != origin:
+                        inbound.put(('replicate', user_id, doc))
+            elif kind == 'event':
+                _, user_id, event_kind, args = message
+                if event_kind == 'matched' and self._history is not None:
+                    # Batch matches are confirmed through here, so the front's matcher can skip pairs that met.
+                    self._history.record(*args)
+                    self._history.record(*reversed(args))
+                self.event(user_id, event_kind, args)
+            elif kind in ('ready', 'barrier'):
+                with self._barrier_condition:
+                    self._barriers.append(message)
+                    self._barrier_condition.notify_all()
+
+    def _wait(self, kind):
+        with self._barrier_condition:
+            while sum(1 for message in self._barriers if message[0] == kind) < self.count:
+                self._barrier_condition.wait()
+            replies = [message for message in self._barriers if message[0] == kind]
+            self._barriers = [message for message in self._barriers if message[0] != kind]
+        return replies
+
+    def start(self):
+        self._relay.start()
+        for process in self._processes:
+            process.start()
+        self._wait('ready')
+        logger.info("Coordinator: %s workers are ready", self.count)
+
+    def barrier(self):
+        """
+        Waits until every worker has handled what it was sent so far and returns their update
+        latencies since the last barrier (with `measure`, empty otherwise).
+        """
+        for inbound in self._inbound:
+            inbound.put(('barrier',))
+        return [latency for _, _, latencies in self._wait('barrier') for latency in latencies]
+
+    def stop(self):
+        for inbound in self._inbound:
+            inbound.put(None)
+        for process in self._processes:
+            process.join()
+        self._outbound.put(None)
+        self._relay.join()
+
+
+def main():
+    # The front never changes the profiles itself: main's repository is its replica and isn't flushed.
+    import main as bot
+    from constants import TOKEN
+
+    coordinator = Coordinator(config.SHARDS, bot.users, bot.pool, history=bot.history)
+    updater = Updater(TOKEN)
+    updater.dispatcher.add_handler(TypeHandler(Update, coordinator.route))
+    if config.MATCH_MODE == 'batch':
+        matcher = ShardedBatchMatcher(coordinator, bot.users, bot.pool, None, similarity=bot.hobby_index.similarity,
+                                      excluded=bot.history.met)
+        updater.job_queue.run_repeating(matcher.run, interval=config.MATCH_INTERVAL)
+
+    coordinator.start()
+    if config.UPDATES_MODE == 'webhook':
+        WebhookServer(updater.dispatcher).run(updater)
+    else:
+        updater.start_polling()
+        updater.idle()
+    coordinator.stop()
+    bot.history.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,332 @@
+import json
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+
+from tinydb import TinyDB, Query
+
+import config
+
+# Fields every user document has; SQLiteStorage keeps them in columns and anything else
+# in a JSON `extra` column.
+USER_FIELDS = ('id', 'chat_id', 'nick_name', 'name', 'level', 'age', 'hobbies', 'available')
+
+
+class Storage(ABC):
+    """The operations the bot needs from a user table."""
+
+    @abstractmethod
+    def insert(self, doc):
+        pass
+
+    @abstractmethod
+    def get(self, user_id):
+        pass
+
+    @abstractmethod
+    def update(self, user_id, fields):
+        pass
+
+    @abstractmethod
+    def remove(self, user_id):
+        pass
+
+    @abstractmethod
+    def all(self):
+        pass
+
+    @abstractmethod
+    def available_by_level(self, min_level, max_level):
+        pass
+
+    @abstractmethod
+    def write_batch(self, upserts, removals):
+        """Upserts the `upserts` documents and removes the `removals` ids in a single write."""
+
+    def close(self):
+        pass
+
+
+class TinyDBStorage(Storage):
+    def __init__(self, path=config.DB_PATH):
+        self.db = TinyDB(path)
+        self._table = self.db.table(self.db.default_table_name)
+
+    def insert(self, doc):
+        self._table.insert(doc)
+
+    def get(self, user_id):
+        result = self._table.search(Query().id == user_id)
+        return dict(result[0]) if result else None
+
+    def update(self, user_id, fields):
+        self._table.update(fields, Query().id == user_id)
+
+    def remove(self, user_id):
+        self._table.remove(Query().id == user_id)
+
+    def all(self):
+        return [dict(doc) for doc in self._table.all()]
+
+    def available_by_level(self, min_level, max_level):
+        user = Query()
+        return [dict(doc) for doc in self._table.search((user.available == True) &
+                                                        (user.level >= min_level) & (user.level <= max_level))]
+
+    def write_batch(self, upserts, removals):
+        # TinyDB rewrites the whole file on every change anyway, so the batch is applied to
+        # the raw table and written out once.
+        tables = self.db.storage.read() or {}
+        raw_table = tables.setdefault(self._table.name, {})
+        doc_ids = {doc['id']: doc_id for doc_id, doc in raw_table.items()}
+        next_doc_id = max((int(doc_id) for doc_id in raw_table), default=0) + 1
+
+        for user_id in removals:
+            doc_id = doc_ids.pop(user_id, None)
+            if doc_id is not None:
+                del raw_table[doc_id]
+        for doc in upserts:
+            doc_id = doc_ids.get(doc['id'])
+            if doc_id is None:
+                doc_id = doc_ids[doc['id']] = str(next_doc_id)
+                next_doc_id += 1
+            raw_table[doc_id] = doc
+
+        self.db.storage.write(tables)
+        self._table.clear_cache()
+        # The table caches the next document id; drop it so insert() reads it from the file again.
+        # _next_id is an internal of the pinned tinydb==4.7.0 (see requirements.txt).
+        self._table._next_id = None
+
+    def close(self):
+        self.db.close()
+
+
+class SQLiteStorage(Storage):
+    """
+    SQLite user table in WAL mode.
+
+    All statements are constant, parametrized SQL, so sqlite3 compiles each of them once and
+    reuses the prepared statement from the connection's statement cache.
+    """
+
+    _COLUMNS = USER_FIELDS + ('extra',)
+    _INSERT = 'INSERT OR REPLACE INTO users ({}) VALUES ({})'.format(', '.join(_COLUMNS), ', '.join('?' * len(_COLUMNS)))
+    _SELECT = 'SELECT {} FROM users'.format(', '.join(_COLUMNS))
+
+    def __init__(self, path=config.SQLITE_PATH):
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript('''
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY,
+                chat_id INTEGER NOT NULL,
+                nick_name TEXT,
+                name TEXT,
+                level INTEGER,
+                age INTEGER,
+                hobbies TEXT,
+                available INTEGER NOT NULL DEFAULT 0,
+                extra TEXT
+            );
+            CREATE INDEX IF NOT EXISTS users_chat_id ON users (chat_id);
+            CREATE INDEX IF NOT EXISTS users_available_level ON users (available, level);
+        ''')
+
+    @classmethod
+    def _to_row(cls, doc):
+        extra = {key: value for key, value in doc.items() if key not in USER_FIELDS}
+        row = [doc.get(field) for field in USER_FIELDS]
+        row[USER_FIELDS.index('available')] = int(bool(doc.get('available')))
+        row.append(json.dumps(extra) if extra else None)
+        return row
+
+    @classmethod
+    def _to_doc(cls, row):
+        doc = dict(zip(USER_FIELDS, row))
+        doc['available'] = bool(doc['available'])
+        if row[-1]:
+            doc.update(json.loads(row[-1]))
+        return doc
+
+    def _write(self, statements):
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                for sql, rows in statements:
+                    self._connection.executemany(sql, rows)
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+            self._connection.execute('COMMIT')
+
+    def insert(self, doc):
+        self._write([(self._INSERT, [self._to_row(doc)])])
+
+    def get(self, user_id):
+        with self._lock:
+            row = self._connection.execute(self._SELECT + ' WHERE id = ?', (user_id,)).fetchone()
+        return self._to_doc(row) if row is not None else None
+
+    def update(self, user_id, fields):
+        with self._lock:
+            doc = self.get(user_id)
+            if doc is not None:
+                doc.update(fields)
+                self.insert(doc)
+
+    def remove(self, user_id):
+        self._write([('DELETE FROM users WHERE id = ?', [(user_id,)])])
+
+    def all(self):
+        # Streams the table instead of materializing it.
+        with self._lock:
+            cursor = self._connection.execute(self._SELECT + ' ORDER BY rowid')
+            rows = cursor.fetchmany(1000)
+        while rows:
+            for row in rows:
+                yield self._to_doc(row)
+            with self._lock:
+                rows = cursor.fetchmany(1000)
+
+    def available_by_level(self, min_level, max_level):
+        with self._lock:
+            rows = self._connection.execute(self._SELECT + ' WHERE available = 1 AND level BETWEEN ? AND ?',
+                                            (min_level, max_level)).fetchall()
+        return [self._to_doc(row) for row in rows]
+
+    def write_batch(self, upserts, removals):
+        self._write([
+            ('DELETE FROM users WHERE id = ?', [(user_id,) for user_id in removals]),
+            (self._INSERT, [self._to_row(doc) for doc in upserts]),
+        ])
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def open_storage(backend=config.STORAGE_BACKEND):
+    if backend == 'tinydb':
+        return TinyDBStorage()
+    if backend == 'sqlite':
+        return SQLiteStorage()
+    raise ValueError("Unknown storage backend '{}'".format(backend))
+
+
+def iter_tinydb_documents(path, table='_default', chunk_size=64 * 1024):
+    """
+    Yields the documents of a TinyDB JSON file one by one without loading the whole file.
+
+    The file is a single JSON object of tables, each one an object of documents keyed by
+    their TinyDB ids, so it's read in chunks and decoded one value at a time.
+    """
+    decoder = json.JSONDecoder()
+
+    with open(path, encoding='utf-8') as file:
+        buffer = ''
+        position = 0
+        eof = False
+
+        def fill():
+            nonlocal buffer, position, eof
+            chunk = file.read(chunk_size)
+            if not chunk:
+                eof = True
+            buffer = buffer[position:] + chunk
+            position = 0
+
+        def skip(expected=None):
+            # Skips whitespace and returns the next character, consuming it if it's `expected`.
+            nonlocal position
+            while True:
+                while position < len(buffer) and buffer[position].isspace():
+                    position += 1
+                if position < len(buffer) or eof:
+                    break
+                fill()
+            char = buffer[position] if position < len(buffer) else ''
+            if expected is not None:
+                if char not in expected:
+                    raise ValueError("{}: expected one of {!r}, got {!r}".format(path, expected, char))
+                position += 1
+            return char
+
+        def value():
+            nonlocal position
+            skip()
+            while True:
+                try:
+                    result, end = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    fill()
+                    continue
+                # A number could be cut at the end of the buffer.
+                if end == len(buffer) and not eof:
+                    fill()
+                    continue
+                position = end
+                return result
+
+        if skip() == '':
+            return
+        skip('{')
+        if skip() == '}':
+            return
+        while True:
+            table_name = value()
+            skip(':')
+            if table_name != table:
+                value()
+            else:
+                skip('{')
+                if skip() != '}':
+                    while True:
+                        value()
+                        skip(':')
+                        yield value()
+                        if skip(',}') == '}':
+                            break
+                else:
+                    skip('}')
+            if skip(',}') == '}':
+                return
+
+
+def iter_users(backend=config.STORAGE_BACKEND):
+    """Yields the users of the configured storage one by one without loading the whole table."""
+    if backend == 'tinydb':
+        if os.path.exists(config.DB_PATH):
+            yield from iter_tinydb_documents(config.DB_PATH)
+        return
+    storage = open_storage(backend)
+    try:
+        yield from storage.all()
+    finally:
+        storage.close()
+
+
+def import_documents(docs, storage, batch_size=1000):
+    """Upserts the `docs` into `storage`, one transaction per batch, and returns how many there were."""
+    imported = 0
+    batch = []
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            storage.write_batch(batch, [])
+            imported += len(batch)
+            batch = []
+    if batch:
+        storage.write_batch(batch, [])
+        imported += len(batch)
+    return imported
+
+
+def import_tinydb(json_path, storage, batch_size=1000):
+    """Copies the users of a TinyDB JSON file into `storage`, one transaction per batch."""
+    return import_documents(iter_tinydb_documents(json_path), storage, batch_size)
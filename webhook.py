@@ -0,0 +1,184 @@
+import hmac
+import json
+import logging
+import queue
+import secrets
+import signal
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram import Update
+
+import config
+
+logger = logging.getLogger(__name__)
+
+_BUSY = b'HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, handler, max_connections):
+        super().__init__(address, handler)
+        self._max_connections = max_connections
+        self._connections = threading.BoundedSemaphore(max_connections)
+
+    def process_request(self, request, client_address):
+        # Waiting here would stop the accept loop (and shutdown()), so the extra connections are refused.
+        if not self._connections.acquire(blocking=False):
+            logger.warning("WebhookServer: %s connections are open, %s is refused", self._max_connections,
+                           client_address[0])
+            try:
+                request.sendall(_BUSY)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        try:
+            super().process_request(request, client_address)
+        except BaseException:
+            self._connections.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self._connections.release()
+
+
+class WebhookServer:
+    """
+    Receives updates that Telegram POSTs to http://listen:port/secret and feeds them to the
+    dispatcher.
+
+    At most `max_connections` connections are served at a time, the ones beyond get a 503,
+    and a connection that stays silent for `timeout` seconds is closed. Bodies over
+    `max_body_size` bytes are rejected without being read. Parsed updates wait in a queue of `queue_size`
+    that a single thread drains into Dispatcher.process_update, so they are handled in the
+    order they arrived. When the queue stays full for `queue_timeout` seconds the request
+    gets a 503 and Telegram delivers the update again later.
+    """
+
+    def __init__(self, dispatcher, listen=config.WEBHOOK_LISTEN, port=config.WEBHOOK_PORT,
+                 secret=config.WEBHOOK_SECRET, max_connections=config.WEBHOOK_MAX_CONNECTIONS,
+                 max_body_size=config.WEBHOOK_MAX_BODY_SIZE, queue_size=config.WEBHOOK_QUEUE_SIZE,
+                 queue_timeout=config.WEBHOOK_QUEUE_TIMEOUT, timeout=config.WEBHOOK_TIMEOUT):
+        self._dispatcher = dispatcher
+        self._address = (listen, port)
+        # Without a configured secret a random one is used, which set_webhook then tells Telegram.
+        self.path = '/' + (secret or secrets.token_urlsafe(32))
+        self._max_connections = max_connections
+        self._max_body_size = max_body_size
+        self._queue_timeout = queue_timeout
+        self._timeout = timeout
+        self._updates = queue.Queue(queue_size)
+        self._server = None
+        self._worker = None
+
+    @property
+    def address(self):
+        return self._server.server_address[:2] if self._server is not None else self._address
+
+    def depth(self):
+        return self._updates.qsize()
+
+    def _handler(self):
+        webhook = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Idle keep-alive connections and stalled bodies would hold a connection slot forever.
+            timeout = webhook._timeout
+
+            def _respond(self, status):
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def do_POST(self):
+                if not hmac.compare_digest(self.path.encode(), webhook.path.encode()):
+                    self.close_connection = True
+                    self._respond(404)
+                    return
+
+                try:
+                    length = int(self.headers.get('Content-Length', ''))
+                except ValueError:
+                    self.close_connection = True
+                    self._respond(411)
+                    return
+                if length < 0 or length > webhook._max_body_size:
+                    self.close_connection = True
+                    self._respond(413)
+                    return
+
+                try:
+                    body = self.rfile.read(length)
+                except OSError:
+                    logger.info("WebhookServer: %s didn't send the body in time", self.client_address[0])
+                    self.close_connection = True
+                    return
+                try:
+                    update = Update.de_json(json.loads(body), webhook._dispatcher.bot)
+                except (ValueError, TypeError, KeyError, AttributeError):
+                    update = None
+                if update is None:
+                    self._respond(400)
+                    return
+
+                try:
+                    webhook._updates.put(update, timeout=webhook._queue_timeout)
+                except queue.Full:
+                    logger.warning("WebhookServer: the update queue is full, update %s is refused", update.update_id)
+                    self._respond(503)
+                    return
+                self._respond(200)
+
+            def log_message(self, format, *args):
+                logger.debug("WebhookServer: " + format, *args)
+
+        return Handler
+
+    def _run(self):
+        while True:
+            update = self._updates.get()
+            if update is None:
+                return
+            # Errors are handled (and logged) by the dispatcher's error handlers.
+            self._dispatcher.process_update(update)
+
+    def start(self):
+        self._server = _Server(self._address, self._handler(), self._max_connections)
+        self._worker = threading.Thread(target=self._run, name='WebhookServer-dispatcher', daemon=True)
+        self._worker.start()
+        threading.Thread(target=self._server.serve_forever, name='WebhookServer', daemon=True).start()
+        logger.info("WebhookServer: listening at http://%s:%s", *self.address)
+
+    def stop(self):
+        """Stops accepting updates and waits for the queued ones to be handled."""
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
+        self._updates.put(None)
+        self._worker.join()
+        self._worker = None
+
+    def run(self, updater):
+        """Serves the updates for `updater` (registering the webhook with WEBHOOK_URL) until SIGINT or SIGTERM."""
+        updater.job_queue.start()
+        self.start()
+        if config.WEBHOOK_URL:
+            updater.bot.set_webhook(url=config.WEBHOOK_URL.rstrip('/') + self.path,
+                                    max_connections=config.WEBHOOK_MAX_CONNECTIONS)
+
+        stopped = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: stopped.set())
+        stopped.wait()
+
+        self.stop()
+        updater.job_queue.stop()